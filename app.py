@@ -3,7 +3,12 @@ import os
 import shutil
 from pathlib import Path
 # Import from the local file
-from backend import CodeRAG
+from backend import CodeRAG, warmup_models
+
+@st.cache_resource
+def start_model_warmup():
+    """Loads the embedding model and reranker on a background thread, once per process."""
+    return warmup_models(background=True)
 
 st.set_page_config(page_title="GitHub Code Assistant", page_icon="🤖", layout="wide")
 
@@ -86,7 +91,8 @@ Remember: Keep the headers exactly as requested. Be helpful and clear!"""
                             try:
                                 # ask_question returns a generator, so we need to collect all chunks
                                 analysis_chunks = []
-                                for chunk in st.session_state.rag.ask_question(analysis_prompt):
+                                # One-off prompt: kept out of the chat's Ollama session
+                                for chunk in st.session_state.rag.ask_question(analysis_prompt, chat_session=False):
                                     analysis_chunks.append(chunk)
                                 
                                 analysis_text = ''.join(analysis_chunks)
@@ -202,8 +208,8 @@ with col2:
                     rag = CodeRAG(repo_url, model_name=model_name)
                     st.session_state.rag = rag
                     rag.clone_repo()
-                    chunks = rag.load_and_process_files()
-                    rag.create_vector_store(chunks)
+                    # Re-analysis only re-embeds files changed since the last indexed commit
+                    st.toast(rag.update_index())
                     
                     # Phase 3: Load history
                     st.session_state.chat_history = rag.load_history()
@@ -236,13 +242,15 @@ if prompt := st.chat_input("Ask about the codebase..."):
                 # Streaming with metrics
                 full_response = st.write_stream(st.session_state.rag.ask_question(prompt))
                 
-                cache_entry = st.session_state.rag.cache.get(prompt, {})
+                cache_entry = st.session_state.rag.last_response
                 metrics = cache_entry.get("metrics", {})
                 sources = cache_entry.get("source_documents", [])
                 
                 # Show metrics
-                if metrics:
-                    st.caption(f"⏱️ Search: {metrics.get('search_time')}s | AI: {metrics.get('llm_time')}s | Total: {metrics.get('total_time')}s")
+                if metrics.get("cached"):
+                    st.caption(f"⚡ Cached answer | Search: {metrics.get('search_time')}s | Total: {metrics.get('total_time')}s")
+                elif metrics:
+                    st.caption(f"⏱️ Search: {metrics.get('search_time')}s | First token: {metrics.get('ttft')}s | AI: {metrics.get('llm_time')}s | Total: {metrics.get('total_time')}s")
                 
                 # Append to history and SAVE
                 st.session_state.chat_history.append({"role": "assistant", "content": full_response})
@@ -253,4 +261,10 @@ if prompt := st.chat_input("Ask about the codebase..."):
                         for doc in sources:
                             src_name = os.path.basename(doc.metadata.get('source', 'file'))
                             st.markdown(f"📍 `{src_name}`")
+                            if doc.metadata.get("aliases"):
+                                # Deduplicated copies of the same code
+                                st.caption("Also in: " + ", ".join(f"`{os.path.relpath(a, st.session_state.rag.repo_path)}`" for a in doc.metadata["aliases"]))
                             st.code(doc.page_content, language="python")
+
+# The page is on screen by now: warm the models up without holding back the first render
+start_model_warmup()
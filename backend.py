@@ -1,50 +1,2046 @@
 import os
 import shutil
 from pathlib import Path
-import git
-from typing import List, Dict, Any, Generator
+from typing import List, Dict, Any, Generator, Optional
 import time
 import json
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
-try:
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-except ImportError:
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from endee_client import EndeeDB
-from langchain_community.llms import Ollama
-# Removed brittle chain imports to increase compatibility
-# from langchain.chains import RetrievalQA
-# from langchain.prompts import PromptTemplate
-from sentence_transformers import CrossEncoder  # 2️⃣ Add a Reranker ⚡
-from rank_bm25 import BM25Okapi # 🚀 Phase 2: Hybrid Search
+import threading
+import hashlib
+import asyncio
+import atexit
+import codecs
+import contextlib
+import importlib
+import multiprocessing
+import queue
+import zlib
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import msgpack
+import requests
+from endee_client import get_collection
 import re
+import ast
+
+
+class _LazyImport:
+    """
+    Stands in for a heavy module or class until first use, so importing backend
+    (and rendering the UI) doesn't wait for torch, transformers or langchain.
+    Candidates are (module, attribute) pairs tried in order; attribute None means the module.
+    """
+    def __init__(self, *candidates):
+        self._candidates = candidates
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            for i, (module_name, attr) in enumerate(self._candidates):
+                try:
+                    module = importlib.import_module(module_name)
+                except ImportError:
+                    if i == len(self._candidates) - 1:
+                        raise
+                    continue
+                self._target = getattr(module, attr) if attr else module
+                break
+        return self._target
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+
+# 🚀 Heavy dependencies load in the stage that first needs them
+git = _LazyImport(("git", None))
+SentenceTransformerEmbeddings = _LazyImport(("langchain_community.embeddings", "SentenceTransformerEmbeddings"))
+CrossEncoder = _LazyImport(("sentence_transformers", "CrossEncoder"))  # 2️⃣ Add a Reranker ⚡
+Document = _LazyImport(("langchain_core.documents", "Document"), ("langchain.schema", "Document"))
+
+# Embedding batches are sized so each forward pass sees roughly this much text
+EMBED_BATCH_CHARS = 64_000
+MIN_EMBED_BATCH = 16
+MAX_EMBED_BATCH = 512
+# Embedded chunks are buffered and sent to Endee in bulk requests of this size
+INSERT_BATCH_SIZE = 2048
+
+# Extensions indexed by load_and_process_files
+SUPPORTED_EXTENSIONS = {'py', 'js', 'java', 'ts', 'cpp', 'c', 'cs', 'go', 'rs', 'swift', 'kt', 'rb', 'php', 'html', 'css', 'md', 'json'}
+
+# File selection (see FileSelector): directories of vendored dependencies and build output
+VENDOR_DIRS = {'node_modules', 'bower_components', 'jspm_packages', 'vendor', 'vendors', 'third_party',
+               'third-party', 'thirdparty', 'site-packages', '__pycache__', 'venv', 'dist', 'build', 'target', 'Pods', 'Carthage'}
+# Generated files recognized by name (gitignore glob syntax)
+GENERATED_FILES = ['*.min.js', '*.min.css', '*.bundle.js', '*-bundle.js', '*.map', 'package-lock.json',
+                   '*.pb.go', '*_pb2.py', '*.generated.*', '*.designer.cs']
+MAX_FILE_BYTES = 1024 * 1024  # larger source files are almost always generated or data
+MAX_DATA_FILE_BYTES = 128 * 1024  # .json is mostly fixtures and schemas past this size
+SNIFF_BYTES = 8000  # git's binary heuristic: a NUL byte in the first 8000 bytes
+MINIFIED_LINE_CHARS = 300  # average line length of a minified file
+
+# Structural chunking (see _chunk_text): chunks end on function, class and block boundaries, without overlap
+EMBED_MAX_TOKENS = 256  # all-MiniLM-L6-v2's max_seq_length; anything past it is never embedded
+CHUNK_MAX_TOKENS = EMBED_MAX_TOKENS * 7 // 8  # in _count_tokens estimates; the rest is headroom for WordPiece
+BRACE_EXTENSIONS = {'js', 'java', 'ts', 'cpp', 'c', 'cs', 'go', 'rs', 'swift', 'kt', 'php', 'css'}
+# Files over this size are read and chunked one window at a time, so memory stays flat
+STREAM_SPLIT_BYTES = 256 * 1024
+STREAM_WINDOW_CHARS = 256 * 1024
+
+# Bare mirrors kept per repo URL; each analysis fetches into one and checks out a worktree
+MIRROR_DIR = "git_mirrors"
+MIRROR_STAMP = "LAST_USED"  # touched on every use, drives eviction
+MIRROR_MAX_AGE_DAYS = 30
+MIRROR_MAX_BYTES = 5 * 1024 ** 3
+
+# Below this many files, loading and splitting stay in-process (pool startup costs more)
+PARALLEL_MIN_FILES = 64
+# Bounded buffers between streaming ingestion stages (in files, files and embedded batches)
+PIPELINE_FILE_QUEUE = 256
+PIPELINE_CHUNK_QUEUE = 64
+PIPELINE_VECTOR_QUEUE = 4
+
+# Files written next to the vector store at ingestion time
+INDEX_STATE_FILE = "index_state.json"  # last indexed commit and next free chunk number
+CORPUS_FILE = "corpus.msgpack"        # stream of [chunk_id, source, content, start, tokens] records
+BM25_TOKENS_FILE = "bm25_tokens.i32"  # every chunk's token ids, concatenated
+BM25_OFFSETS_FILE = "bm25_offsets.i64"  # start of each chunk in the token file (+ end)
+BM25_DF_FILE = "bm25_df.i32"          # document frequency of each token id
+BM25_VOCAB_FILE = "bm25_vocab.msgpack"  # token strings in id order, written last
+DEDUPE_FILE = "dedupe.msgpack"        # fingerprints and aliases of the indexed chunks (see Deduplicator)
+
+# Near-duplicate chunks: 64-bit SimHash over token shingles, split into bands for lookup
+SIMHASH_SHINGLE = 3
+NEAR_DUP_MAX_DISTANCE = 3  # differing bits; with 4 bands of 16 bits one band always matches exactly
+NEAR_DUP_MIN_TOKENS = 32   # shorter chunks (braces, imports) are only deduplicated exactly
+
+# BM25 parameters (rank_bm25's BM25Okapi defaults) and the hashed sparse vocabulary size for Endee
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+SPARSE_DIM = 1 << 20
+
+# Loaded corpora are shared by every CodeRAG in the process: path -> (stamp, chunks, bm25, vocab)
+_CORPUS_CACHE = {}
+_CORPUS_LOCK = threading.Lock()
+# Same for the small per-term statistics used by server-side hybrid search
+_TERM_STATS_CACHE = {}
+
+# Reranking: fused retrieval scores are reciprocal-rank fusion, like Endee's server-side hybrid
+RERANKER_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANKER_ONNX_FILE = "onnx/model_qint8_avx2.onnx"  # int8-quantized export published with the model
+RERANK_CACHE_SIZE = 4096
+RERANK_KEEP = 3
+RRF_K = 60
+RERANK_CLEAR_MARGIN = 1.5  # a fused score this many times the runner-up's is a clear winner
+RERANK_DEPTH_RATIO = 0.75  # only candidates this close to the best fused score are reranked
+
+# Prompt context: reranked candidates are packed into this many (estimated) tokens
+CONTEXT_TOKEN_BUDGET = 1024
+CONTEXT_CANDIDATES = 6
+CONTEXT_HEADER_TOKENS = 8  # the "Source: ...\nCode:" line added per snippet
+CONTEXT_MERGE_GAP = 3      # chunks this close are adjacent (blank lines between blocks are stripped)
+
+# Local LLM served by Ollama
+OLLAMA_URL = "http://127.0.0.1:11434"
+OLLAMA_KEEP_ALIVE = "30m"        # keeps the model, and the KV cache of its last prompt, loaded between turns
+OLLAMA_NUM_CTX = 8192
+OLLAMA_SESSION_MAX_TOKENS = 6144  # a chat session past this many tokens starts over
+_OLLAMA_CLIENTS = {}
+_OLLAMA_CLIENTS_LOCK = threading.Lock()
+# Fixed instructions sent as Ollama's system prompt, so every request shares the same prefix
+SYSTEM_PROMPT = """You are a professional coding assistant. Use the code snippets given with each question to answer it.
+Detailed and accurate answers are prioritized. If you don't know, say so."""
+
+# Answers are cached per repo next to its vector store
+ANSWER_CACHE_FILE = "answer_cache.msgpack"
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL = 7 * 24 * 3600  # seconds
+ANSWER_CACHE_SIMILARITY = 0.95    # cosine similarity for reusing a near-duplicate question's answer
+_ANSWER_CACHES = {}
+_ANSWER_CACHES_LOCK = threading.Lock()
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# Default cap for the shared embedding cache (~370 MB of float32 at 384 dims)
+EMBEDDING_CACHE_MAX_ENTRIES = 250_000
+_EMBEDDING_CACHES = {}
+_EMBEDDING_CACHES_LOCK = threading.Lock()
+
+# Loaded models, shared by every CodeRAG in the process: key -> model
+_MODELS = {}
+_MODEL_LOCKS = {}
+_MODELS_LOCK = threading.Lock()
+_WARMUP_THREAD = None
+
+
+# Lines that close a block never start a chunk; comments and decorators stay with what follows them
+_CLOSER = re.compile(r"\s*(?:[}\])]|end\b|</)")
+# (in brace languages # starts a preprocessor statement, not a comment)
+_LEADING = re.compile(r"\s*(?:#|@)")
+_BRACE_LEADING = re.compile(r"\s*(?://|/\*|\*|@)")
+_STRING_OR_LINE_COMMENT = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`|//.*|/\*.*?\*/')
+
+
+def _python_levels(text: str, lines: List[str]) -> Optional[List[Optional[int]]]:
+    """Nesting depth of each line that starts a statement (decorators included), from the AST."""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    levels = [None] * len(lines)
+
+    def visit(body, depth):
+        for node in body:
+            first = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])]) - 1
+            if 0 <= first < len(levels) and levels[first] is None:
+                levels[first] = depth
+            for field in ("body", "handlers", "orelse", "finalbody"):
+                children = getattr(node, field, None)
+                if isinstance(children, list):
+                    visit([c for c in children if hasattr(c, "lineno")], depth + 1)
+
+    visit(tree.body, 0)
+    return levels
+
+
+def _brace_levels(lines: List[str]) -> List[Optional[int]]:
+    """Bracket depth at the start of each line, skipping strings and comments (a heuristic, not a parser)."""
+    levels, depth, in_comment = [], 0, False
+    for line in lines:
+        code = line
+        if in_comment:
+            levels.append(None)
+            if "*/" not in line:
+                continue
+            in_comment, code = False, line.split("*/", 1)[1]
+        else:
+            levels.append(depth if line.strip() and not _CLOSER.match(line) else None)
+        code = _STRING_OR_LINE_COMMENT.sub("", code)
+        if "/*" in code:
+            in_comment, code = True, code.split("/*", 1)[0]
+        depth = max(0, depth + sum(code.count(c) for c in "{([") - sum(code.count(c) for c in "})]"))
+    return levels
+
+
+def _indent_levels(lines: List[str]) -> List[Optional[int]]:
+    levels = []
+    for line in lines:
+        expanded = line.expandtabs(4)
+        stripped = expanded.lstrip()
+        levels.append(len(expanded) - len(stripped) if stripped and not _CLOSER.match(line) else None)
+    return levels
+
+
+def _markdown_levels(lines: List[str]) -> List[Optional[int]]:
+    """Headings by level, then paragraphs; never inside a code fence."""
+    levels, in_fence, previous_blank = [], False, True
+    for line in lines:
+        stripped = line.strip()
+        level = None
+        if stripped.startswith("```"):
+            level = None if in_fence else 7
+            in_fence = not in_fence
+        elif not in_fence and stripped:
+            heading = len(stripped) - len(stripped.lstrip("#"))
+            level = heading if 0 < heading <= 6 else (7 if previous_blank else None)
+        levels.append(level)
+        previous_blank = not stripped
+    return levels
+
+
+def _line_levels(text: str, lines: List[str], ext: str) -> List[Optional[int]]:
+    if ext == "py":
+        levels = _python_levels(text, lines)
+        if levels is not None:
+            return levels
+    if ext in BRACE_EXTENSIONS:
+        return _brace_levels(lines)
+    if ext == "md":
+        return _markdown_levels(lines)
+    return _indent_levels(lines)
+
+
+def _leading_starts(lines: List[str], ext: str) -> List[int]:
+    """
+    For each line, where the run of comment and decorator lines directly above it
+    begins (the line itself if there is none). One pass, so cuts attach in O(1).
+    """
+    leading = None if ext == "md" else _BRACE_LEADING if ext in BRACE_EXTENSIONS else _LEADING
+    starts, run = [], 0
+    for i, line in enumerate(lines):
+        starts.append(run)
+        if not (leading and line.strip() and leading.match(line)):
+            run = i + 1
+    return starts
+
+
+def _block_ranges(lines, levels, prefix, lo: int, hi: int, budget: int, lead=None) -> List[tuple]:
+    """
+    Splits lines[lo:hi] into ranges of at most budget tokens. Cuts go before the
+    outermost statements first (above their comments and decorators), and only
+    blocks that are still too big are split at their inner statements. Neighbouring
+    small blocks are then packed together. Iterative: every split makes its pieces
+    strictly smaller, so deep or degenerate structure can't exhaust the stack.
+    """
+    lead = lead or list(range(len(lines)))
+    pieces, pending = [], [(lo, hi)]
+    while pending:
+        a, b = pending.pop()
+        if prefix[b] - prefix[a] <= budget or b - a == 1:
+            pieces.append((a, b))
+            continue
+        # Cuts go above a statement's comments; the statement opening this block
+        # (and the comments in front of it) can't be cut from it
+        candidates = [(levels[i], lead[i]) for i in range(a + 1, b) if levels[i] is not None and lead[i] > a]
+        if candidates:
+            top = min(level for level, _ in candidates)
+            cuts = sorted({cut for level, cut in candidates if level == top})
+        else:
+            cuts = list(range(a + 1, b))  # no structure left: line by line
+        bounds = [a] + cuts + [b]
+        pending.extend(reversed(list(zip(bounds, bounds[1:]))))
+
+    ranges, current = [], None
+    for a, b in pieces:
+        if current and prefix[b] - prefix[current[0]] <= budget:
+            current = (current[0], b)
+        else:
+            if current:
+                ranges.append(current)
+            current = (a, b)
+    if current:
+        ranges.append(current)
+    return ranges
+
+
+def _chunk_text(text: str, ext: str, offset: int = 0, budget: int = CHUNK_MAX_TOKENS) -> List[tuple]:
+    """
+    Structural chunking: Python by its AST, brace languages by bracket depth, markdown
+    by headings and the rest by indentation. Returns (start offset, token count, text)
+    for chunks of at most budget tokens that don't overlap, with starts shifted by offset.
+    """
+    lines = text.splitlines(keepends=True)
+    line_tokens = [_count_tokens(line) for line in lines]
+    prefix = [0]
+    for count in line_tokens:
+        prefix.append(prefix[-1] + count)
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+
+    chunks = []
+    try:
+        ranges = _block_ranges(lines, _line_levels(text, lines, ext), prefix, 0, len(lines), budget,
+                               _leading_starts(lines, ext))
+    except Exception as e:
+        # Never lose a file to the heuristics: fall back to packing plain lines
+        print(f"Structural chunking failed ({e}); packing lines instead.")
+        ranges = _block_ranges(lines, [None] * len(lines), prefix, 0, len(lines), budget)
+    for lo, hi in ranges:
+        while lo < hi and not lines[lo].strip():
+            lo += 1
+        if lo == hi:
+            continue
+        chunk = "".join(lines[lo:hi]).rstrip()
+        tokens = prefix[hi] - prefix[lo]
+        if tokens <= budget:
+            chunks.append((offset + starts[lo], tokens, chunk))
+            continue
+        # A single line over budget (minified code, long literals) is cut by tokens
+        pieces = [m.start() for m in _TOKEN_PIECE.finditer(chunk)]
+        for k in range(0, len(pieces), budget):
+            a = pieces[k] if k else 0
+            b = pieces[k + budget] if k + budget < len(pieces) else len(chunk)
+            if chunk[a:b].strip():
+                chunks.append((offset + starts[lo] + a, min(budget, len(pieces) - k), chunk[a:b]))
+    return chunks
+
+
+# A line starting at column 0 that doesn't close a block: a safe place to end a window
+_WINDOW_CUT = re.compile(r"\n(?=[^\s}\])])")
+
+
+def _window_cut(text: str) -> int:
+    """End of a window's text: the last top-level line start in its second half, else the last newline or space."""
+    cut = None
+    for match in _WINDOW_CUT.finditer(text, len(text) // 2):
+        cut = match.end()
+    if cut is None:
+        cut = max(text.rfind("\n"), text.rfind(" ")) + 1
+    return cut or len(text)
+
+
+def _decodes_as_utf8(file_path: str, block_bytes: int = 1024 * 1024) -> bool:
+    """True if the whole file reads as UTF-8, checked a block at a time."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(block_bytes)
+                decoder.decode(block, final=not block)
+                if not block:
+                    return True
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+def _split_file_windows(file_path: str, window_chars: int = STREAM_WINDOW_CHARS):
+    """
+    Streams a large file: reads window_chars at a time, ends each window on a
+    top-level line and carries the rest over, and yields each window's chunks
+    (start offsets are for the whole file). Memory is bounded by the window,
+    not the file. Like _split_file, files that can't be read or decoded yield
+    nothing; decoding is checked up front since chunks go out as they are made.
+    """
+    if not _decodes_as_utf8(file_path):
+        return
+    ext = file_path.rsplit('.', 1)[-1].lower()
+    offset, carry = 0, ""
+    try:
+        with open(file_path, encoding='utf-8') as f:
+            while True:
+                block = f.read(window_chars)
+                text = carry + block
+                if not block:
+                    if text.strip():
+                        yield _chunk_text(text, ext, offset)
+                    return
+                cut = _window_cut(text)
+                yield _chunk_text(text[:cut], ext, offset)
+                offset += cut
+                carry = text[cut:]
+    except (OSError, UnicodeDecodeError):
+        return  # changed or removed while being read
+
+
+def _is_large_file(file_path: str) -> bool:
+    try:
+        return os.path.getsize(file_path) > STREAM_SPLIT_BYTES
+    except OSError:
+        return False
+
+
+def _split_file(file_path: str):
+    """
+    Process-pool worker: reads one file and returns its chunks as
+    (start offset, token count, text), or None if it can't be decoded.
+    Kept compact so results pickle cheaply. Large files go through
+    _split_file_windows instead (see _split_stream).
+    """
+    try:
+        with open(file_path, encoding='utf-8') as f:
+            text = f.read()
+    except Exception:
+        # Fallback for encoding issues
+        return None
+    return _chunk_text(text, file_path.rsplit('.', 1)[-1].lower())
+
+
+def _split_stream(file_paths, workers: int):
+    """
+    Yields (file_path, chunks) in input order, skipping files that can't be read
+    or decoded. Small files are split in a process pool with a bounded window of
+    files in flight; large files are streamed in this process one window of chunks
+    at a time (several yields for the same path), so no file is held whole.
+    """
+    if workers <= 1:
+        for file_path in file_paths:
+            if _is_large_file(file_path):
+                for texts in _split_file_windows(file_path):
+                    yield file_path, texts
+                continue
+            texts = _split_file(file_path)
+            if texts is not None:
+                yield file_path, texts
+        return
+
+    # Forking here would copy the pipeline's other threads' locks mid-use; forkserver
+    # (spawn where unavailable) starts the workers from a clean process instead
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+        in_flight = deque()
+
+        def finished(all_done=False):
+            while in_flight and (all_done or len(in_flight) >= workers * 4 or in_flight[0][1].done()):
+                done_path, future = in_flight.popleft()
+                if future.result() is not None:
+                    yield done_path, future.result()
+
+        for file_path in file_paths:
+            if _is_large_file(file_path):
+                # Streamed here, after the files ahead of it
+                yield from finished(all_done=True)
+                for texts in _split_file_windows(file_path):
+                    yield file_path, texts
+                continue
+            in_flight.append((file_path, pool.submit(_split_file, file_path)))
+            yield from finished()
+        yield from finished(all_done=True)
+
+
+_TOKEN_PIECE = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+def _count_tokens(text: str) -> int:
+    """
+    Approximate LLM token count: words in 4-char pieces plus one per symbol,
+    close to BPE on code without needing the Ollama model's tokenizer.
+    """
+    return len(_TOKEN_PIECE.findall(text))
+
+
+def _chunk_document(chunk_id: str, source: str, content: str, start: int = None, tokens: int = None):
+    """A chunk as a Document; start and tokens are absent from corpora saved before they were tracked."""
+    metadata = {"source": source, "chunk_id": chunk_id}
+    if start is not None:
+        metadata["start"] = start
+    if tokens is not None:
+        metadata["tokens"] = tokens
+    return Document(page_content=content, metadata=metadata)
+
+
+def _tokenize(text: str) -> List[str]:
+    """Tokenizer shared by BM25 indexing and queries."""
+    return re.sub(r'[^\w\s]', '', text.lower()).split()
+
+
+class CorpusWriter:
+    """
+    Streams chunk records and their BM25 token ids to disk during ingestion.
+    Files are written under temporary names and swapped in by close().
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.vocab = {}
+        self.df = []
+        self.offsets = [0]
+        self._corpus = open(self._tmp(CORPUS_FILE), "wb")
+        self._tokens = open(self._tmp(BM25_TOKENS_FILE), "wb")
+
+    def _tmp(self, name):
+        return os.path.join(self.path, name + ".tmp")
+
+    def add(self, chunk_id: str, source: str, content: str, start: int = None, tokens: int = None):
+        self._corpus.write(msgpack.packb([chunk_id, source, content, start, tokens], use_bin_type=True))
+        token_ids = [self.vocab.setdefault(token, len(self.vocab)) for token in _tokenize(content)]
+        np.asarray(token_ids, dtype=np.int32).tofile(self._tokens)
+        self.df.extend([0] * (len(self.vocab) - len(self.df)))
+        for token_id in set(token_ids):
+            self.df[token_id] += 1
+        self.offsets.append(self.offsets[-1] + len(token_ids))
+
+    def abort(self):
+        """Discards a partially written corpus, leaving the previous one in place."""
+        self._corpus.close()
+        self._tokens.close()
+        for name in (CORPUS_FILE, BM25_TOKENS_FILE):
+            if os.path.exists(self._tmp(name)):
+                os.remove(self._tmp(name))
+
+    def close(self):
+        self._corpus.close()
+        self._tokens.close()
+        np.asarray(self.offsets, dtype=np.int64).tofile(self._tmp(BM25_OFFSETS_FILE))
+        np.asarray(self.df, dtype=np.int32).tofile(self._tmp(BM25_DF_FILE))
+        with open(self._tmp(BM25_VOCAB_FILE), "wb") as f:
+            f.write(msgpack.packb(list(self.vocab), use_bin_type=True))
+        # The vocab file goes last: its mtime marks a complete corpus
+        for name in (CORPUS_FILE, BM25_TOKENS_FILE, BM25_OFFSETS_FILE, BM25_DF_FILE, BM25_VOCAB_FILE):
+            os.replace(self._tmp(name), os.path.join(self.path, name))
+
+
+def _corpus_stamp(path: str):
+    """Identifies one complete write of a saved corpus (see CorpusWriter.close)."""
+    stat = os.stat(os.path.join(path, BM25_VOCAB_FILE))
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_corpus(path: str):
+    """
+    Returns (chunks, bm25, vocab) for a persisted corpus, or None if there is none.
+    Loaded once per process and reused until the corpus is rewritten.
+    """
+    vocab_path = os.path.join(path, BM25_VOCAB_FILE)
+    if not os.path.exists(vocab_path):
+        return None
+    stamp = _corpus_stamp(path)
+
+    with _CORPUS_LOCK:
+        cached = _CORPUS_CACHE.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1:]
+
+        with open(vocab_path, "rb") as f:
+            vocab = {token: i for i, token in enumerate(msgpack.unpackb(f.read(), raw=False))}
+        chunks = []
+        with open(os.path.join(path, CORPUS_FILE), "rb") as f:
+            for record in msgpack.Unpacker(f, raw=False):
+                chunks.append(_chunk_document(*record))
+        tokens = np.fromfile(os.path.join(path, BM25_TOKENS_FILE), dtype=np.int32)
+        offsets = np.fromfile(os.path.join(path, BM25_OFFSETS_FILE), dtype=np.int64)
+
+        bm25 = BM25Index(tokens, offsets) if chunks else None
+        _CORPUS_CACHE[path] = (stamp, chunks, bm25, vocab)
+        return chunks, bm25, vocab
+
+
+def _bm25_idf(df: np.ndarray, num_docs: int) -> np.ndarray:
+    """BM25Okapi's IDF per token id."""
+    idf = np.log(num_docs - df + 0.5) - np.log(df + 0.5)
+    # BM25Okapi floors negative IDFs at a fraction of the average IDF
+    floor = BM25_EPSILON * idf.mean() if len(idf) else 0.0
+    return np.where(idf < 0, floor, idf)
+
+
+class TermStats:
+    """Per-term document frequencies of a saved corpus; all that BM25 query weighting needs."""
+    def __init__(self, vocab: List[str], df: np.ndarray, num_docs: int):
+        self.num_docs = num_docs
+        self.idf = dict(zip(vocab, _bm25_idf(df, num_docs).tolist()))
+
+
+class BM25Index:
+    """
+    Inverted BM25 index over token ids, scoring like BM25Okapi but only touching
+    the postings of the query terms. Postings are term-major NumPy arrays of doc
+    ids with each posting's precomputed term-frequency part of the score.
+    Top-k uses MaxScore pruning: once the best partial scores beat what the
+    remaining terms could add, those terms only score the existing candidates.
+    """
+    def __init__(self, tokens: np.ndarray, offsets: np.ndarray, k1: float = BM25_K1, b: float = BM25_B):
+        self.num_docs = len(offsets) - 1
+        doc_len = np.diff(offsets).astype(np.float64)
+        avgdl = doc_len.sum() / self.num_docs
+
+        # One posting per (term, doc) pair, sorted by term then doc
+        doc_ids = np.repeat(np.arange(self.num_docs, dtype=np.int64), np.diff(offsets))
+        pairs, tf = np.unique(tokens.astype(np.int64) * self.num_docs + doc_ids, return_counts=True)
+        terms, docs = np.divmod(pairs, self.num_docs)
+        num_terms = int(terms[-1]) + 1 if len(terms) else 0
+
+        df = np.bincount(terms, minlength=num_terms)
+        self.starts = np.concatenate(([0], np.cumsum(df)))
+        self.doc_ids = docs.astype(np.int32)
+        tf = tf.astype(np.float64)
+        self.impacts = tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len[docs] / avgdl))
+        self.idf = _bm25_idf(df.astype(np.float64), self.num_docs)
+        self.max_impact = np.zeros(num_terms)
+        if len(self.impacts):
+            self.max_impact[df > 0] = np.maximum.reduceat(self.impacts, self.starts[:-1][df > 0])
+
+    def _postings(self, term: int):
+        start, end = self.starts[term], self.starts[term + 1]
+        return self.doc_ids[start:end], self.impacts[start:end]
+
+    def get_scores(self, query: List[int]) -> np.ndarray:
+        """Scores of every document, as BM25Okapi.get_scores; unknown ids (e.g. -1) score nothing."""
+        scores = np.zeros(self.num_docs)
+        for term in query:
+            if 0 <= term < len(self.idf):
+                docs, impacts = self._postings(term)
+                scores[docs] += self.idf[term] * impacts
+        return scores
+
+    def top_n(self, query: List[int], n: int = 5) -> List[int]:
+        """
+        Indices of the n best documents, in BM25Okapi.get_top_n order: by score,
+        ties to the higher index, padded with zero-score documents.
+        """
+        n = min(n, self.num_docs)
+        weights = Counter(t for t in query if 0 <= t < len(self.idf))
+        weights = {t: qf * self.idf[t] for t, qf in weights.items()}
+        if n <= 0:
+            return []
+        if any(w <= 0 for w in weights.values()):
+            # Zero or negative weights break the upper bounds; score everything instead
+            return np.argsort(self.get_scores(query), kind="stable")[::-1][:n].tolist()
+
+        # Highest-impact terms first; bound[i] is the most terms i.. can add to any document
+        terms = sorted(weights, key=lambda t: weights[t] * self.max_impact[t], reverse=True)
+        bound = np.cumsum([weights[t] * self.max_impact[t] for t in terms][::-1])[::-1]
+
+        scores = np.zeros(self.num_docs)
+        seen = np.zeros(self.num_docs, dtype=bool)
+        threshold = 0.0
+        i = 0
+        while i < len(terms) and bound[i] >= threshold:
+            # Essential term: any document in its postings could still reach the top n
+            docs, impacts = self._postings(terms[i])
+            scores[docs] += weights[terms[i]] * impacts
+            seen[docs] = True
+            if len(docs) >= n:
+                # The n-th best partial score among these docs is a lower bound on the final cut-off
+                threshold = max(threshold, np.partition(scores[docs], -n)[-n])
+            i += 1
+        candidates = np.flatnonzero(seen)
+        for term in terms[i:]:
+            # Non-essential term: only documents already seen can still make it
+            docs, impacts = self._postings(term)
+            pos = np.searchsorted(docs, candidates)
+            hit = pos < len(docs)  # past the last posting (or no postings at all)
+            hit[hit] = docs[pos[hit]] == candidates[hit]
+            scores[candidates[hit]] += weights[term] * impacts[pos[hit]]
+
+        ranked = candidates[np.argsort(scores[candidates], kind="stable")[::-1]][:n].tolist()
+        if len(ranked) < n:
+            # BM25Okapi returns the highest-index zero-score documents next
+            seen = set(ranked)
+            for doc in range(self.num_docs - 1, -1, -1):
+                if len(ranked) == n:
+                    break
+                if doc not in seen:
+                    ranked.append(doc)
+        return ranked
+
+
+def load_term_stats(path: str):
+    """Returns the TermStats of a saved corpus (cached per process), or None if there is none."""
+    if not os.path.exists(os.path.join(path, BM25_VOCAB_FILE)):
+        return None
+    stamp = _corpus_stamp(path)
+    with _CORPUS_LOCK:
+        cached = _TERM_STATS_CACHE.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(os.path.join(path, BM25_VOCAB_FILE), "rb") as f:
+            vocab = msgpack.unpackb(f.read(), raw=False)
+        df = np.fromfile(os.path.join(path, BM25_DF_FILE), dtype=np.int32).astype(np.float64)
+        num_docs = os.path.getsize(os.path.join(path, BM25_OFFSETS_FILE)) // 8 - 1
+        stats = TermStats(vocab, df, num_docs)
+        _TERM_STATS_CACHE[path] = (stamp, stats)
+        return stats
+
+
+def load_readme_chunks(path: str) -> List[Any]:
+    """Streams the saved corpus once and keeps only README chunks (for the README boost)."""
+    readme = []
+    corpus_path = os.path.join(path, CORPUS_FILE)
+    if os.path.exists(corpus_path):
+        with open(corpus_path, "rb") as f:
+            for record in msgpack.Unpacker(f, raw=False):
+                if "readme.md" in record[1].lower():
+                    readme.append(_chunk_document(*record))
+    return readme
+
+
+def _simhash(tokens: List[str]) -> int:
+    """64-bit SimHash of a token list's shingles (crc32-based, so stable across processes)."""
+    shingles = [" ".join(tokens[i:i + SIMHASH_SHINGLE]).encode("utf-8")
+                for i in range(max(len(tokens) - SIMHASH_SHINGLE + 1, 1))]
+    hashes = np.fromiter((zlib.crc32(s) | zlib.crc32(s, 0x9E3779B9) << 32 for s in shingles),
+                         dtype=np.uint64, count=len(shingles))
+    votes = ((hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)).sum(axis=0)
+    return sum(1 << int(bit) for bit in np.flatnonzero(votes * 2 > len(shingles)))
+
+
+class Deduplicator:
+    """
+    Drops duplicate chunks before they are embedded. Identical files are caught by a
+    whole-file hash, then single chunks by a hash of their whitespace-normalized text and,
+    for chunks of NEAR_DUP_MIN_TOKENS or more, by SimHash within NEAR_DUP_MAX_DISTANCE bits.
+    Each duplicate is stored once. The other files it appears in are kept as aliases of that chunk.
+    """
+    BANDS = 4
+
+    def __init__(self, state: Dict[str, Any] = None):
+        state = state or {}
+        self.chunks = {}   # chunk id -> [source, digest, simhash]
+        self.exact = {}    # digest -> chunk id
+        self.bands = [{} for _ in range(self.BANDS)]  # 16-bit band -> chunk ids
+        self.files = state.get("files", {})      # file digest -> chunk ids its chunks resolved to
+        self.aliases = state.get("aliases", {})  # chunk id -> other sources containing it
+        self.stats = Counter()
+        for chunk_id, (source, digest, simhash) in state.get("chunks", {}).items():
+            self._add(chunk_id, source, digest, simhash)
+
+    @staticmethod
+    def _band_keys(simhash: int):
+        return [(simhash >> (16 * band)) & 0xFFFF for band in range(Deduplicator.BANDS)]
+
+    def _add(self, chunk_id, source, digest, simhash):
+        self.chunks[chunk_id] = [source, digest, simhash]
+        self.exact.setdefault(digest, chunk_id)
+        if simhash is not None:
+            for band, key in zip(self.bands, self._band_keys(simhash)):
+                band.setdefault(key, []).append(chunk_id)
+
+    def _near(self, simhash: int) -> Optional[str]:
+        for band, key in zip(self.bands, self._band_keys(simhash)):
+            for chunk_id in band.get(key, ()):
+                if bin(self.chunks[chunk_id][2] ^ simhash).count("1") <= NEAR_DUP_MAX_DISTANCE:
+                    return chunk_id
+        return None
+
+    def _alias(self, chunk_id: str, source: str):
+        if source != self.chunks[chunk_id][0] and source not in self.aliases.get(chunk_id, ()):
+            self.aliases.setdefault(chunk_id, []).append(source)
+
+    def unique(self, source: str, texts, first_id: int):
+        """
+        Returns (chunk_id, start, tokens, text) for the chunks of one file that are new,
+        numbered from first_id. The rest are recorded as aliases of the chunks they repeat.
+        """
+        file_digest = hashlib.blake2b("\0".join(text for _, _, text in texts).encode("utf-8"), digest_size=16).digest()
+        if file_digest in self.files and all(chunk_id in self.chunks for chunk_id in self.files[file_digest]):
+            for chunk_id in self.files[file_digest]:
+                self._alias(chunk_id, source)
+            self.stats["duplicate files"] += 1
+            self.stats["duplicate chunks"] += len(texts)
+            return []
+
+        kept, resolved = [], []
+        for start, tokens, text in texts:
+            words = text.split()
+            digest = hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=16).digest()
+            terms = _tokenize(text)
+            simhash = _simhash(terms) if len(terms) >= NEAR_DUP_MIN_TOKENS else None
+            match = self.exact.get(digest)
+            if match is None and simhash is not None:
+                match = self._near(simhash)
+                if match is not None:
+                    self.stats["near-duplicate chunks"] += 1
+            if match is not None:
+                self._alias(match, source)
+                self.stats["duplicate chunks"] += 1
+                resolved.append(match)
+                continue
+            chunk_id = f"chunk_{first_id + len(kept)}"
+            self._add(chunk_id, source, digest, simhash)
+            kept.append((chunk_id, start, tokens, text))
+            resolved.append(chunk_id)
+        self.files[file_digest] = resolved
+        return kept
+
+    def forget(self, sources) -> List[str]:
+        """
+        Drops the chunks and aliases of the given sources (changed or deleted files).
+        Returns the other sources that were aliases of dropped chunks and must be re-indexed.
+        """
+        sources = set(sources)
+        orphaned = set()
+        for chunk_id in [c for c, (source, _, _) in self.chunks.items() if source in sources]:
+            _, digest, simhash = self.chunks.pop(chunk_id)
+            if self.exact.get(digest) == chunk_id:
+                del self.exact[digest]
+            if simhash is not None:
+                for band, key in zip(self.bands, self._band_keys(simhash)):
+                    band[key].remove(chunk_id)
+            orphaned.update(self.aliases.pop(chunk_id, ()))
+        for chunk_id in list(self.aliases):
+            self.aliases[chunk_id] = [a for a in self.aliases[chunk_id] if a not in sources]
+            if not self.aliases[chunk_id]:
+                del self.aliases[chunk_id]
+        self.files = {d: ids for d, ids in self.files.items() if all(c in self.chunks for c in ids)}
+        return sorted(orphaned - sources)
+
+    def state(self) -> Dict[str, Any]:
+        return {"chunks": self.chunks, "files": self.files, "aliases": self.aliases}
+
+    def save(self, path: str):
+        tmp = os.path.join(path, DEDUPE_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(msgpack.packb(self.state(), use_bin_type=True))
+        os.replace(tmp, os.path.join(path, DEDUPE_FILE))
+
+    @classmethod
+    def load(cls, path: str) -> "Deduplicator":
+        try:
+            with open(os.path.join(path, DEDUPE_FILE), "rb") as f:
+                return cls(msgpack.unpackb(f.read(), raw=False))
+        except (OSError, ValueError):
+            return cls()
+
+
+def _sparse_index(token: str) -> int:
+    """Hashes a token into Endee's sparse dimension, so no vocabulary is shared with the server."""
+    return zlib.crc32(token.encode("utf-8")) & (SPARSE_DIM - 1)
+
+
+def _to_sparse(weights: Dict[int, float]):
+    indices = sorted(weights)
+    return indices, [weights[i] for i in indices]
+
+
+class SparseEncoder:
+    """
+    BM25 sparse vectors for Endee's server-side hybrid search. Chunks carry the
+    saturated term-frequency part of BM25 and queries carry IDF, so the server's
+    sparse dot product is the BM25 score. Chunk lengths are normalized against a
+    running average, since the final average is unknown while streaming.
+    """
+    def __init__(self, total_tokens: int = 0, num_docs: int = 0):
+        self.total_tokens = total_tokens
+        self.num_docs = num_docs
+
+    def state(self) -> List[int]:
+        return [self.total_tokens, self.num_docs]
+
+    def encode_document(self, text: str):
+        tokens = _tokenize(text)
+        self.total_tokens += len(tokens)
+        self.num_docs += 1
+        avgdl = max(self.total_tokens / self.num_docs, 1.0)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / avgdl)
+        
+        weights = {}
+        for token, tf in Counter(tokens).items():
+            index = _sparse_index(token)
+            weights[index] = weights.get(index, 0.0) + tf * (BM25_K1 + 1) / (tf + norm)
+        return _to_sparse(weights)
+
+    @staticmethod
+    def encode_query(text: str, term_stats: TermStats):
+        weights = {}
+        for token in _tokenize(text):
+            idf = term_stats.idf.get(token)
+            if idf:
+                index = _sparse_index(token)
+                weights[index] = weights.get(index, 0.0) + idf
+        return _to_sparse(weights)
+
+
+_DONE = object()  # End-of-stream marker between pipeline stages
+
+
+def _queue_put(q, item, stop) -> bool:
+    """Blocking put that gives up once the pipeline is stopping."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _queue_drain(q, stop, stats):
+    """Yields items up to the end marker, charging time spent blocked to stats["wait"]."""
+    while True:
+        waited = time.perf_counter()
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            stats["wait"] += time.perf_counter() - waited
+            if stop.is_set():
+                return
+            continue
+        stats["wait"] += time.perf_counter() - waited
+        if item is _DONE:
+            return
+        yield item
+
+
+def _glob_regex(pattern: str) -> str:
+    """Translates a gitignore-style glob (*, ?, [...], **) into a regex for repo-relative paths."""
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("/**", i) and i + 3 == len(pattern):
+            out.append("/.*")
+            break
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and pattern.find("]", i + 2) != -1:
+            end = pattern.find("]", i + 2)
+            body = pattern[i + 1:end].replace("\\", "\\\\")
+            out.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+            i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+def _compile_glob(pattern: str):
+    """Patterns without a slash match at any depth; the rest are anchored to the file's directory."""
+    anchored = "/" in pattern
+    return re.compile(("" if anchored else "(?:.*/)?") + _glob_regex(pattern.lstrip("/")))
+
+
+class FileSelector:
+    """
+    Decides which files get indexed, and records why the rest were skipped.
+    Honors .gitignore files and .gitattributes linguist-vendored / linguist-generated
+    markers at every level, prunes vendored and build directories during the walk, and
+    skips generated, oversized, binary and minified files. Patterns are compiled once per file.
+    """
+    REPORT_EXAMPLES = 3
+
+    def __init__(self, root: str, extensions=SUPPORTED_EXTENSIONS, max_bytes: int = None):
+        self.root = root
+        self.extensions = extensions
+        self.max_bytes = max_bytes  # None = MAX_FILE_BYTES, and MAX_DATA_FILE_BYTES for .json
+        self.skipped = Counter()
+        self.examples = {}
+        self._generated = re.compile("|".join(f"(?:{_compile_glob(p).pattern})" for p in GENERATED_FILES))
+        self._rules = {}  # directory -> (ignore rules, attribute rules) in effect there
+
+    # --- .gitignore / .gitattributes -------------------------------------------
+
+    def _read_lines(self, rel_dir: str, name: str) -> List[str]:
+        try:
+            with open(os.path.join(self.root, *rel_dir.split("/"), name), encoding="utf-8", errors="ignore") as f:
+                return [line.rstrip("\n\r") for line in f if line.strip() and not line.startswith("#")]
+        except OSError:
+            return []
+
+    def _dir_rules(self, rel_dir: str):
+        """Rules for files under rel_dir: the parent's plus those in rel_dir's own files (later wins)."""
+        if rel_dir in self._rules:
+            return self._rules[rel_dir]
+        ignore, attributes = self._dir_rules(rel_dir.rpartition("/")[0]) if rel_dir else ([], [])
+        base = rel_dir + "/" if rel_dir else ""
+
+        new_ignore = []
+        for line in self._read_lines(rel_dir, ".gitignore"):
+            line = line.rstrip()
+            negate = line.startswith("!")
+            pattern = line[1:] if negate else line
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if pattern:
+                new_ignore.append((base, _compile_glob(pattern), negate, dir_only))
+
+        new_attributes = []
+        for line in self._read_lines(rel_dir, ".gitattributes"):
+            pattern, *attrs = line.split()
+            flags = {}
+            for attr in attrs:
+                name, _, value = attr.lstrip("-!").partition("=")
+                if name in ("linguist-vendored", "linguist-generated"):
+                    flags[name] = not attr.startswith(("-", "!")) and value.lower() not in ("false", "0")
+            if flags and not pattern.startswith("!"):
+                new_attributes.append((base, _compile_glob(pattern), flags))
+
+        rules = (ignore + new_ignore, attributes + new_attributes)
+        self._rules[rel_dir] = rules
+        return rules
+
+    def _ignored(self, rel_path: str, is_dir: bool, rules) -> bool:
+        for base, regex, negate, dir_only in reversed(rules):
+            if rel_path.startswith(base) and (is_dir or not dir_only) and regex.fullmatch(rel_path[len(base):]):
+                return not negate
+        return False
+
+    def _attribute(self, rel_path: str, name: str, rules) -> Optional[bool]:
+        for base, regex, flags in reversed(rules):
+            if name in flags and rel_path.startswith(base) and regex.fullmatch(rel_path[len(base):]):
+                return flags[name]
+        return None
+
+    # --- decisions ----------------------------------------------------------------
+
+    def dir_skip_reason(self, rel_dir: str) -> Optional[str]:
+        name = rel_dir.rpartition("/")[2]
+        if name.startswith('.'):
+            return "hidden"
+        ignore, attributes = self._dir_rules(rel_dir.rpartition("/")[0])
+        # A -linguist-vendored rule anywhere above can re-include files, so the directory is walked
+        if name in VENDOR_DIRS and all(flags.get("linguist-vendored") is not False for _, _, flags in attributes):
+            return "vendored"
+        if self._ignored(rel_dir, True, ignore):
+            return "gitignored"
+        return None
+
+    def path_skip_reason(self, rel_path: str) -> Optional[str]:
+        """Checks that only need the path: extension, directories, .gitignore, .gitattributes and names."""
+        parent, _, name = rel_path.rpartition("/")
+        if name.split('.')[-1] not in self.extensions:
+            return "unsupported"
+        parts = parent.split("/") if parent else []
+        if any(part.startswith('.') for part in parts):
+            return "hidden"
+        ignore, attributes = self._dir_rules(parent)
+        vendored = self._attribute(rel_path, "linguist-vendored", attributes)
+        if vendored or (vendored is None and any(part in VENDOR_DIRS for part in parts)):
+            return "vendored"
+        if self._ignored(rel_path, False, ignore):
+            return "gitignored"
+        generated = self._attribute(rel_path, "linguist-generated", attributes)
+        if generated or (generated is None and self._generated.fullmatch(rel_path)):
+            return "generated"
+        return None
+
+    def content_skip_reason(self, file_path: str, size: int = None) -> Optional[str]:
+        """Checks that read the file: size caps and a sniff of the first SNIFF_BYTES."""
+        try:
+            size = os.path.getsize(file_path) if size is None else size
+            limit = self.max_bytes or (MAX_DATA_FILE_BYTES if file_path.endswith(".json") else MAX_FILE_BYTES)
+            if size > limit:
+                return "too large"
+            with open(file_path, "rb") as f:
+                sample = f.read(SNIFF_BYTES)
+        except OSError:
+            return "unreadable"
+        if b"\0" in sample:
+            return "binary"
+        if len(sample) == SNIFF_BYTES and len(sample) / (sample.count(b"\n") + 1) > MINIFIED_LINE_CHARS:
+            return "minified"
+        return None
+
+    def accepts(self, rel_path: str) -> bool:
+        """Full check for one repo-relative (forward-slash) path, e.g. a file changed since the last index."""
+        reason = self.path_skip_reason(rel_path)
+        parts = rel_path.split("/")
+        # The walk never enters a skipped directory; here each ancestor is checked instead
+        for depth in range(1, len(parts)):
+            if reason is None:
+                reason = self.dir_skip_reason("/".join(parts[:depth]))
+        if reason is None:
+            reason = self.content_skip_reason(os.path.join(self.root, *parts))
+        if reason not in (None, "unsupported", "hidden"):
+            self._skip(rel_path, reason)
+        return reason is None
+
+    def _skip(self, rel_path: str, reason: str):
+        self.skipped[reason] += 1
+        examples = self.examples.setdefault(reason, [])
+        if len(examples) < self.REPORT_EXAMPLES:
+            examples.append(rel_path)
+
+    def walk(self):
+        """Yields the absolute paths of indexable files in a stable order, pruning skipped directories."""
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.root, *rel_dir.split("/")) if rel_dir else self.root) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    reason = self.dir_skip_reason(rel_path)
+                    if reason is None:
+                        subdirs.append(rel_path)
+                    elif reason != "hidden":
+                        self._skip(rel_path + "/", reason)
+                    continue
+                reason = self.path_skip_reason(rel_path)
+                if reason is None:
+                    try:
+                        size = entry.stat().st_size
+                    except OSError:
+                        size = None
+                    reason = self.content_skip_reason(entry.path, size)
+                if reason is None:
+                    yield entry.path
+                elif reason not in ("unsupported", "hidden"):
+                    self._skip(rel_path, reason)
+            # Depth-first in name order, like the sorted os.walk this replaces
+            stack.extend(reversed(subdirs))
+
+    def report(self) -> Dict[str, Any]:
+        return {reason: {"count": count, "examples": self.examples[reason]}
+                for reason, count in self.skipped.most_common()}
+
+    def summary(self) -> str:
+        if not self.skipped:
+            return "Skipped no files."
+        parts = [f"{reason} {count} (e.g. {', '.join(self.examples[reason])})" for reason, count in self.skipped.most_common()]
+        return f"Skipped {sum(self.skipped.values())} paths: " + "; ".join(parts)
+
+
+class IngestPipeline:
+    """
+    Streaming ingestion: walk → load/split → embed → insert. Each stage runs on its
+    own thread with a bounded queue in front of the next one, so a slow stage
+    backs up its producers instead of growing buffers, and memory stays flat.
+    Loading and splitting are fused in the process-pool workers.
+    """
+    STAGES = ("walk", "split", "embed", "insert")
+
+    def __init__(self, rag, db, writer, sources=None, dedupe=None, first_chunk: int = 0):
+        self.rag = rag
+        self.db = db
+        self.writer = writer
+        self.sources = sources  # files to index; None walks the whole repository
+        self.first_chunk = first_chunk
+        self.next_chunk = first_chunk
+        self.dedupe = dedupe if dedupe is not None else Deduplicator()  # duplicates are dropped before embedding ⚡
+        self.stop = threading.Event()
+        self.errors = []
+        self.stats = {name: {"items": 0, "busy": 0.0, "wait": 0.0} for name in self.STAGES}
+        self.files = queue.Queue(maxsize=PIPELINE_FILE_QUEUE)
+        self.chunks = queue.Queue(maxsize=PIPELINE_CHUNK_QUEUE)
+        self.vectors = queue.Queue(maxsize=PIPELINE_VECTOR_QUEUE)
+
+    def run(self) -> Dict[str, Any]:
+        start = time.time()
+        threads = [
+            threading.Thread(target=self._run_stage, args=("walk", self._walk, self.files), daemon=True),
+            threading.Thread(target=self._run_stage, args=("split", self._split, self.chunks), daemon=True),
+            threading.Thread(target=self._run_stage, args=("embed", self._embed, self.vectors), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            self._insert()
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.summary(time.time() - start)
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        stages = {}
+        for name, stat in self.stats.items():
+            stages[name] = {
+                "items": stat["items"],
+                "busy_seconds": round(stat["busy"], 2),
+                "items_per_sec": round(stat["items"] / stat["busy"], 1) if stat["busy"] > 0 else None
+            }
+        chunks = self.next_chunk - self.first_chunk
+        return {
+            "chunks": chunks,
+            "seconds": round(elapsed, 2),
+            "chunks_per_sec": round(chunks / max(elapsed, 1e-6), 1),
+            "duplicates": dict(self.dedupe.stats),
+            "stages": stages
+        }
+
+    def _run_stage(self, name, produce, outbox):
+        """Pumps a stage's generator into its outbox, timing the work between queue waits."""
+        stat = self.stats[name]
+        try:
+            items = produce(stat)
+            while not self.stop.is_set():
+                started, waited = time.perf_counter(), stat["wait"]
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    stat["busy"] += time.perf_counter() - started - (stat["wait"] - waited)
+                if not _queue_put(outbox, item, self.stop):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            _queue_put(outbox, _DONE, self.stop)
+
+    def _walk(self, stat):
+        for file_path in self.rag._iter_source_files() if self.sources is None else self.sources:
+            stat["items"] += 1
+            yield file_path
+
+    def _split(self, stat):
+        files = _queue_drain(self.files, self.stop, stat)
+        workers = self.rag.ingest_workers
+        if self.sources is not None and len(self.sources) < PARALLEL_MIN_FILES:
+            workers = 1  # a handful of changed files isn't worth starting workers
+        last = None
+        for file_path, texts in _split_stream(files, workers):
+            if file_path != last:
+                stat["items"] += 1
+                last = file_path
+            yield file_path, texts
+
+    def _embed(self, stat):
+        batch, batch_size = [], None
+        for file_path, texts in _queue_drain(self.chunks, self.stop, stat):
+            for chunk_id, start, tokens, text in self.dedupe.unique(file_path, texts, self.next_chunk):
+                batch.append(_chunk_document(chunk_id, file_path, text, start, tokens))
+                self.next_chunk += 1
+            # The first few hundred chunks are a good enough sample to size batches
+            if batch_size is None and len(batch) >= 256:
+                batch_size = self.rag._embedding_batch_size(batch)
+            while batch_size and len(batch) >= batch_size:
+                head, batch = batch[:batch_size], batch[batch_size:]
+                stat["items"] += len(head)
+                yield head, self.rag._embed_texts([c.page_content for c in head], batch_size=batch_size)
+        if batch:
+            batch_size = batch_size or self.rag._embedding_batch_size(batch)
+            stat["items"] += len(batch)
+            yield batch, self.rag._embed_texts([c.page_content for c in batch], batch_size=batch_size)
+
+    def _insert(self):
+        stat = self.stats["insert"]
+        buffered, buffered_vectors = [], []
+        for batch, vectors in _queue_drain(self.vectors, self.stop, stat):
+            buffered.extend(batch)
+            buffered_vectors.append(vectors)
+            if len(buffered) >= INSERT_BATCH_SIZE:
+                self._flush(stat, buffered, buffered_vectors)
+                buffered, buffered_vectors = [], []
+        if buffered and not self.stop.is_set():
+            self._flush(stat, buffered, buffered_vectors)
+
+    def _flush(self, stat, chunks, vectors):
+        started = time.perf_counter()
+        self.rag._insert_batch(self.db, 0, chunks, np.concatenate(vectors))
+        # Only inserted chunks make it into the saved corpus
+        for chunk in chunks:
+            self.writer.add(chunk.metadata["chunk_id"], chunk.metadata["source"], chunk.page_content,
+                            chunk.metadata.get("start"), chunk.metadata.get("tokens"))
+        stat["items"] += len(chunks)
+        stat["busy"] += time.perf_counter() - started
+
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    """Holds an exclusive lock on `path` across processes (fcntl on POSIX, msvcrt on Windows)."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK gives up after ~10 seconds; keep waiting
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache shared across repos and runs.
+    Vectors are appended to a memory-mapped float32 file; the index maps
+    sha1(model, text) to a row and keeps LRU order. Going over max_entries
+    evicts the least recently used quarter and compacts into a new file.
+
+    Several processes can share a cache: writes hold a file lock, new rows are
+    logged to a journal next to the index snapshot, and each writer replays the
+    rows others appended before claiming the next ones.
+    """
+    def __init__(self, path: str, model_name: str, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        # One directory per model keeps the vector width uniform
+        self.path = os.path.join(path, hashlib.sha1(model_name.encode()).hexdigest()[:12])
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.dim = None
+        self.generation = 0
+        self._rows = OrderedDict()  # key -> row, least recently used first
+        self._count = 0  # Rows used in the current vectors file
+        self._matrix = None
+        self._unsaved = 0
+        self._stamp = None  # identity of the index snapshot last read or written
+        self._journal_offset = 0  # bytes of the journal already replayed
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with _file_lock(self._lock_path):
+                self._load()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.path, "index.msgpack")
+
+    @property
+    def _journal_path(self):
+        return os.path.join(self.path, "journal.msgpack")
+
+    @property
+    def _lock_path(self):
+        return os.path.join(self.path, "lock")
+
+    def _vectors_path(self, generation):
+        return os.path.join(self.path, f"embeddings.{generation}.f32")
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha1(self.model_name.encode() + b"\0" + text.encode("utf-8", "surrogatepass")).digest()
+
+    def _index_stamp(self):
+        try:
+            stat = os.stat(self._index_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        """Reads the index snapshot and replays the journal. Call with the file lock held."""
+        self.dim, self.generation, self._count, self._rows, self._matrix = None, 0, 0, OrderedDict(), None
+        self._stamp, self._journal_offset = self._index_stamp(), 0
+        if self._stamp is None:
+            return
+        try:
+            with open(self._index_path, "rb") as f:
+                index = msgpack.unpackb(f.read(), raw=False)
+            self.dim, self.generation, self._count = index["dim"], index["generation"], index["count"]
+            self._rows = OrderedDict(zip(index["keys"], index["rows"]))
+            self._replay()
+        except Exception as e:
+            print(f"Embedding cache unreadable ({e}); starting empty.")
+            self.dim, self.generation, self._count, self._rows, self._matrix = None, 0, 0, OrderedDict(), None
+
+    def _replay(self):
+        """Applies journal entries appended since the last replay and maps any new rows."""
+        try:
+            with open(self._journal_path, "rb") as f:
+                f.seek(self._journal_offset)
+                unpacker = msgpack.Unpacker(f, raw=False)
+                start = self._journal_offset
+                # A batch cut short by a crash is left unread and overwritten by the next append
+                for batch in unpacker:
+                    for key, row in batch:
+                        self._rows[key] = row
+                        self._count = max(self._count, row + 1)
+                    self._journal_offset = start + unpacker.tell()
+        except FileNotFoundError:
+            pass
+        if self.dim is not None and (self._matrix is None or len(self._matrix) < self._count):
+            self._map(max(self._count, os.path.getsize(self._vectors_path(self.generation)) // (4 * self.dim)))
+
+    def _sync(self):
+        """Catches up with other processes' writes. Call with the file lock held."""
+        if self._index_stamp() != self._stamp:
+            self._load()  # the snapshot was rewritten (flush or compaction elsewhere)
+        else:
+            self._replay()
+
+    def _map(self, capacity):
+        """(Re)maps the current vectors file, growing it to `capacity` rows."""
+        self._matrix = None
+        os.makedirs(self.path, exist_ok=True)
+        file_path = self._vectors_path(self.generation)
+        with open(file_path, "r+b" if os.path.exists(file_path) else "w+b") as f:
+            if os.path.getsize(file_path) < capacity * self.dim * 4:
+                f.truncate(capacity * self.dim * 4)
+        self._matrix = np.memmap(file_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def get_many(self, keys) -> Dict[int, np.ndarray]:
+        """Returns {position in keys: vector} for every cached key."""
+        found = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is not None:
+                    self._rows.move_to_end(key)
+                    found[i] = np.array(self._matrix[row])
+        return found
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, _file_lock(self._lock_path):
+            self._sync()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._map(1024)
+                self._save()  # journal entries always follow a snapshot that records dim
+            capacity = 0 if self._matrix is None else len(self._matrix)
+            if self._count + len(keys) > capacity:
+                capacity = max(capacity, 1024)
+                while capacity < self._count + len(keys):
+                    capacity *= 2
+                self._map(capacity)
+            added = []
+            for key, vector in zip(keys, vectors):
+                if key in self._rows:
+                    continue
+                self._matrix[self._count] = vector
+                self._rows[key] = self._count
+                added.append([key, self._count])
+                self._count += 1
+            if added:
+                self._append_journal(added)
+                self._unsaved += len(added)
+            if len(self._rows) > self.max_entries:
+                self._evict()
+
+    def _append_journal(self, entries):
+        with open(self._journal_path, "r+b" if os.path.exists(self._journal_path) else "w+b") as f:
+            f.seek(self._journal_offset)
+            f.write(msgpack.packb(entries, use_bin_type=True))
+            f.truncate()
+            self._journal_offset = f.tell()
+
+    def _evict(self):
+        """Drops the least recently used quarter and compacts survivors into a new file."""
+        keep = int(self.max_entries * 0.75)
+        while len(self._rows) > keep:
+            self._rows.popitem(last=False)
+        survivors = np.array(self._matrix[list(self._rows.values())])
+        old_generation = self.generation
+        self.generation += 1
+        self._count = 0
+        self._map(max(1024, len(survivors)))
+        self._matrix[:len(survivors)] = survivors
+        self._rows = OrderedDict((key, row) for row, key in enumerate(self._rows))
+        self._count = len(survivors)
+        self._save()
+        # The old file is only garbage once the new index points elsewhere
+        try:
+            os.remove(self._vectors_path(old_generation))
+        except OSError:
+            pass
+
+    def _save(self):
+        """Writes the index snapshot and empties the journal. Call with the file lock held."""
+        if self._matrix is None:
+            return
+        self._matrix.flush()
+        index = {
+            "dim": self.dim,
+            "generation": self.generation,
+            "count": self._count,
+            "keys": list(self._rows.keys()),
+            "rows": list(self._rows.values()),
+        }
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(msgpack.packb(index, use_bin_type=True))
+        # Journal first: after a crash in between, the old snapshot just misses some rows
+        with open(self._journal_path, "wb"):
+            pass
+        os.replace(tmp_path, self._index_path)
+        self._stamp, self._journal_offset = self._index_stamp(), 0
+        self._unsaved = 0
+
+    def flush(self):
+        """Folds the journal into the index snapshot if anything was added since the last flush."""
+        with self._lock:
+            if not self._unsaved:
+                return
+            with _file_lock(self._lock_path):
+                self._sync()
+                self._save()
+
+
+def get_embedding_cache(path: str, model_name: str = EMBEDDING_MODEL) -> EmbeddingCache:
+    """Returns the process-wide cache for a directory and model, flushed at exit."""
+    key = (os.path.abspath(path), model_name)
+    with _EMBEDDING_CACHES_LOCK:
+        cache = _EMBEDDING_CACHES.get(key)
+        if cache is None:
+            cache = EmbeddingCache(path, model_name)
+            atexit.register(cache.flush)
+            _EMBEDDING_CACHES[key] = cache
+        return cache
+
+
+class Reranker:
+    """
+    Cross-encoder reranking with an LRU cache of (query hash, chunk id) -> score
+    and an adaptive depth driven by the fused retrieval scores. The "onnx" backend
+    runs the int8-quantized export on CPU; "auto" tries it and falls back to torch.
+    """
+    def __init__(self, model_name: str = RERANKER_MODEL, backend: str = "auto", cache_size: int = RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self.stats = {"hits": 0, "misses": 0, "skipped": 0}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.model, self.backend = self._load(backend)
+
+    def _load(self, backend: str):
+        if backend in ("auto", "onnx"):
+            try:
+                model = CrossEncoder(self.model_name, backend="onnx", model_kwargs={"file_name": RERANKER_ONNX_FILE})
+                return model, "onnx"
+            except Exception as e:
+                # Needs sentence-transformers >= 4 with onnxruntime/optimum installed
+                if backend == "onnx":
+                    print(f"ONNX reranker unavailable ({e}). Using torch.")
+        return CrossEncoder(self.model_name), "torch"
+
+    @staticmethod
+    def _keys(query: str, docs: List[Any]):
+        query_hash = hashlib.blake2b(query.encode("utf-8"), digest_size=16).digest()
+        # Chunk ids are reused by a full re-index, so the content checksum goes along with them
+        return [(query_hash, doc.metadata.get("chunk_id"), zlib.crc32(doc.page_content.encode("utf-8")))
+                for doc in docs]
+
+    def score(self, query: str, docs: List[Any]) -> List[float]:
+        """Cross-encoder scores for docs, predicting only the pairs not cached yet."""
+        keys = self._keys(query, docs)
+        with self._lock:
+            scores = [self._cache.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._cache.move_to_end(key)
+            missing = [i for i, score in enumerate(scores) if score is None]
+            self.stats["hits"] += len(docs) - len(missing)
+            self.stats["misses"] += len(missing)
+
+        if missing:
+            predicted = self.model.predict([[query, docs[i].page_content] for i in missing])
+            with self._lock:
+                for i, score in zip(missing, predicted):
+                    scores[i] = float(score)
+                    self._cache[keys[i]] = scores[i]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return scores
+
+    def rerank(self, query: str, scored_docs: List[Any], keep: int = RERANK_KEEP) -> List[Any]:
+        """
+        Picks the best `keep` docs from (doc, fused score) pairs. A clear fused winner
+        is kept without scoring, and only candidates near the best fused score
+        are sent to the cross-encoder; when those fit in the kept slots, it is skipped.
+        """
+        ranked = sorted(scored_docs, key=lambda pair: pair[1], reverse=True)
+        pinned = []
+        if len(ranked) > 1 and ranked[0][1] >= RERANK_CLEAR_MARGIN * ranked[1][1] > 0:
+            pinned = [ranked.pop(0)[0]]
+        slots = keep - len(pinned)
+        if not ranked or slots <= 0:
+            self.stats["skipped"] += 1
+            return pinned[:keep]
+
+        floor = ranked[0][1] * RERANK_DEPTH_RATIO
+        pool = [doc for doc, fused in ranked if fused >= floor]
+        if len(pool) <= slots:
+            # Everything the reranker could promote is kept anyway
+            self.stats["skipped"] += 1
+            return pinned + [doc for doc, _ in ranked[:slots]]
+
+        scores = self.score(query, pool)
+        order = sorted(range(len(pool)), key=lambda i: scores[i], reverse=True)
+        return pinned + [pool[i] for i in order[:slots]]
+
+
+class ContextPacker:
+    """
+    Packs ranked chunks into a token budget for the LLM prompt. Overlapping and
+    adjacent chunks of the same file merge into one span (corpora indexed before
+    structural chunking overlap by 200 chars), then spans are picked greedily by relevance
+    (1/rank, summed over merged chunks) per token. Token counts come from
+    ingestion and are of raw text, so comment stripping only adds headroom.
+    """
+    def __init__(self, budget_tokens: int = CONTEXT_TOKEN_BUDGET):
+        self.budget_tokens = budget_tokens
+
+    @staticmethod
+    def _tokens(doc) -> int:
+        tokens = doc.metadata.get("tokens")
+        return tokens if tokens is not None else _count_tokens(doc.page_content)
+
+    def _spans(self, docs: List[Any]) -> List[Dict[str, Any]]:
+        spans, by_source, seen = [], {}, set()
+        for rank, doc in enumerate(docs):
+            if doc.page_content in seen:
+                continue
+            seen.add(doc.page_content)
+            span = {"source": doc.metadata.get("source", "unknown"), "start": doc.metadata.get("start"),
+                    "text": doc.page_content, "tokens": self._tokens(doc), "relevance": 1.0 / (rank + 1),
+                    "rank": rank, "chunk_ids": [doc.metadata.get("chunk_id")], "merged": False,
+                    "aliases": list(doc.metadata.get("aliases", []))}
+            if span["start"] is None:
+                spans.append(span)
+            else:
+                by_source.setdefault(span["source"], []).append(span)
+
+        for group in by_source.values():
+            group.sort(key=lambda span: span["start"])
+            current = group[0]
+            for span in group[1:]:
+                end = current["start"] + len(current["text"])
+                if span["start"] > end + CONTEXT_MERGE_GAP:
+                    spans.append(current)
+                    current = span
+                    continue
+                if span["start"] + len(span["text"]) > end:
+                    tail = span["text"][max(0, end - span["start"]):]
+                    current["text"] += ("\n" if span["start"] > end else "") + tail
+                # A span inside the current one only adds its relevance
+                current["relevance"] += span["relevance"]
+                current["rank"] = min(current["rank"], span["rank"])
+                current["chunk_ids"] += span["chunk_ids"]
+                current["aliases"] += [a for a in span["aliases"] if a not in current["aliases"]]
+                current["merged"] = True
+            spans.append(current)
+
+        for span in spans:
+            if span["merged"]:
+                span["tokens"] = _count_tokens(span["text"])
+        return spans
+
+    def pack(self, docs: List[Any]) -> List[Any]:
+        """Returns the packed spans as Documents, most relevant first."""
+        spans = self._spans(docs)
+        chosen, used = [], 0
+        for span in sorted(spans, key=lambda s: s["relevance"] / (s["tokens"] + CONTEXT_HEADER_TOKENS), reverse=True):
+            cost = span["tokens"] + CONTEXT_HEADER_TOKENS
+            if used + cost <= self.budget_tokens:
+                chosen.append(span)
+                used += cost
+        if not chosen and spans:
+            # Even the best span is over budget: send its head
+            span = min(spans, key=lambda s: s["rank"])
+            room = max(self.budget_tokens - CONTEXT_HEADER_TOKENS, 0)
+            span["text"] = span["text"][:len(span["text"]) * room // max(span["tokens"], 1)]
+            span["tokens"] = _count_tokens(span["text"])
+            chosen = [span]
+
+        chosen.sort(key=lambda s: s["rank"])
+        return [Document(page_content=span["text"], metadata={
+            "source": span["source"], "chunk_id": span["chunk_ids"][0], "chunk_ids": span["chunk_ids"],
+            "start": span["start"], "tokens": span["tokens"], "aliases": span["aliases"]
+        }) for span in chosen]
+
+
+class AnswerCache:
+    """
+    Persistent cache of LLM answers for one repo's index, keyed by (indexed commit,
+    model, retrieved chunk ids, normalized query). Given a query vector, a
+    near-duplicate question over the same chunks also hits. The least recently
+    used entries go past max_entries, and entries expire after ttl seconds.
+    """
+    def __init__(self, path: str, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.path = os.path.join(path, ANSWER_CACHE_FILE)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()  # key -> {"scope", "result", "vector", "created"}, least recently used first
+        self._unsaved = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.sub(r'[^\w\s]', ' ', query.lower()).split())
+
+    def key(self, commit: str, model: str, chunk_ids: List[str], query: str):
+        """Returns (scope, key): scope covers everything but the question itself."""
+        scope = hashlib.sha1(json.dumps([commit, model, sorted(map(str, chunk_ids))]).encode()).hexdigest()
+        return scope, hashlib.sha1(f"{scope}\0{self.normalize(query)}".encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                self._entries = OrderedDict(msgpack.unpackb(f.read(), raw=False))
+        except Exception as e:
+            print(f"Answer cache unreadable ({e}); starting empty.")
+            self._entries = OrderedDict()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(msgpack.packb(list(self._entries.items()), use_bin_type=True))
+        os.replace(tmp_path, self.path)
+        self._unsaved = False
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for key in [k for k, entry in self._entries.items() if entry["created"] < cutoff]:
+            del self._entries[key]
+            self._unsaved = True
+
+    def get(self, scope: str, key: str, vector=None) -> Optional[str]:
+        """The cached answer for key, else for the most similar question in the same scope."""
+        with self._lock:
+            self._expire()
+            if key not in self._entries and vector is not None:
+                query = np.asarray(vector, dtype=np.float32)
+                query = query / (np.linalg.norm(query) or 1.0)
+                best = self.similarity
+                for k, entry in self._entries.items():
+                    if entry["scope"] == scope and entry["vector"]:
+                        similarity = float(np.frombuffer(entry["vector"], dtype=np.float32) @ query)
+                        if similarity >= best:
+                            key, best = k, similarity
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self._unsaved = True
+            return entry["result"]
+
+    def put(self, scope: str, key: str, result: str, vector=None):
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            vector = (vector / (np.linalg.norm(vector) or 1.0)).tobytes()
+        with self._lock:
+            self._entries[key] = {"scope": scope, "result": result, "vector": vector, "created": time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._unsaved = False
+
+    def flush(self):
+        """Persists LRU order and expiries if anything changed since the last save."""
+        with self._lock:
+            if self._unsaved:
+                self._save()
+
+
+def get_answer_cache(path: str) -> AnswerCache:
+    """Returns the process-wide AnswerCache for a vector store directory."""
+    with _ANSWER_CACHES_LOCK:
+        cache = _ANSWER_CACHES.get(path)
+        if cache is None:
+            cache = AnswerCache(path)
+            atexit.register(cache.flush)
+            _ANSWER_CACHES[path] = cache
+        return cache
+
+
+class OllamaClient:
+    """
+    Long-lived client for Ollama's /api/generate. The HTTP session is reused
+    across questions, and keep_alive holds the model in memory between turns.
+    Passing the `context` returned with a previous reply continues that
+    conversation without prefilling it again.
+    """
+    def __init__(self, base_url: str = OLLAMA_URL, keep_alive: str = OLLAMA_KEEP_ALIVE):
+        self.base_url = base_url.rstrip("/")
+        self.keep_alive = keep_alive
+        self.session = requests.Session()
+
+    def generate(self, model: str, prompt: str, system: str = None, context: List[int] = None,
+                 stats: Dict[str, Any] = None) -> Generator[str, None, None]:
+        """Streams the reply text; Ollama's final message (timings, `context`) is stored in stats."""
+        payload = {"model": model, "prompt": prompt, "stream": True, "keep_alive": self.keep_alive,
+                   "options": {"num_ctx": OLLAMA_NUM_CTX}}
+        if system:
+            payload["system"] = system
+        if context:
+            payload["context"] = context
+        started = time.time()
+        with self.session.post(f"{self.base_url}/api/generate", json=payload, stream=True, timeout=(5, 600)) as response:
+            if response.status_code != 200:
+                try:
+                    message = response.json().get("error", response.text)
+                except ValueError:
+                    message = response.text
+                raise RuntimeError(f"Ollama returned {response.status_code}: {message}")
+            # chunk_size=None yields tokens as they arrive instead of per 512 bytes
+            for line in response.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                message = json.loads(line)
+                if message.get("error"):
+                    raise RuntimeError(message["error"])
+                if message.get("response"):
+                    if stats is not None and "ttft" not in stats:
+                        stats["ttft"] = round(time.time() - started, 2)
+                    yield message["response"]
+                if message.get("done") and stats is not None:
+                    stats.update(message)
+
+
+def get_ollama_client(base_url: str = OLLAMA_URL) -> OllamaClient:
+    """Returns the process-wide client for an Ollama server."""
+    with _OLLAMA_CLIENTS_LOCK:
+        client = _OLLAMA_CLIENTS.get(base_url)
+        if client is None:
+            client = _OLLAMA_CLIENTS[base_url] = OllamaClient(base_url)
+        return client
+
+
+def get_model(key, loader):
+    """
+    Returns the process-wide model for key, calling loader() on first use.
+    Each key has its own lock, so different models can load concurrently.
+    """
+    model = _MODELS.get(key)
+    if model is not None:
+        return model
+    with _MODELS_LOCK:
+        lock = _MODEL_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _MODELS:
+            started = time.time()
+            _MODELS[key] = loader()
+            print(f"Loaded {key[0]} model {key[1]} in {time.time() - started:.1f}s")
+        return _MODELS[key]
+
+
+def get_embeddings(model_name: str = EMBEDDING_MODEL):
+    return get_model(("embedding", model_name), lambda: SentenceTransformerEmbeddings(model_name=model_name))
+
+
+def get_reranker(backend: str = "auto") -> Reranker:
+    return get_model(("reranker", RERANKER_MODEL, backend), lambda: Reranker(backend=backend))
+
+
+def warmup_models(background: bool = True, reranker_backend: str = "auto"):
+    """Loads the embedding model and reranker ahead of the first request, by default on a daemon thread."""
+    global _WARMUP_THREAD
+    def load():
+        try:
+            get_embeddings()
+            get_reranker(reranker_backend)
+        except Exception as e:
+            # A failed warmup just leaves loading to first use
+            print(f"Model warmup failed: {e}")
+
+    if not background:
+        load()
+        return None
+    with _MODELS_LOCK:
+        if _WARMUP_THREAD is None:
+            _WARMUP_THREAD = threading.Thread(target=load, name="model-warmup", daemon=True)
+            _WARMUP_THREAD.start()
+        return _WARMUP_THREAD
+
+
+# Shared by retrieval stages: the Endee round trip, query embedding and BM25 scoring
+_RETRIEVAL_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+
+
+def _run_sync(coro):
+    """Runs a coroutine to completion from sync code, even if this thread already runs an event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _mirror_in_use(mirror: str) -> bool:
+    """True while any worktree checked out from the mirror still exists on disk."""
+    worktrees = os.path.join(mirror, "worktrees")
+    if not os.path.isdir(worktrees):
+        return False
+    for name in os.listdir(worktrees):
+        try:
+            with open(os.path.join(worktrees, name, "gitdir"), encoding="utf-8") as f:
+                if os.path.exists(f.read().strip()):
+                    return True
+        except OSError:
+            continue
+    return False
+
+
+def evict_mirrors(root: str, max_age_days: float = MIRROR_MAX_AGE_DAYS, max_bytes: int = MIRROR_MAX_BYTES) -> List[str]:
+    """
+    Deletes mirrors unused for max_age_days, then the least recently used ones
+    while the store is over max_bytes. Mirrors with a live worktree are kept.
+    """
+    if not os.path.isdir(root):
+        return []
+    mirrors = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.endswith(".git") or not os.path.isdir(path):
+            continue
+        stamp = os.path.join(path, MIRROR_STAMP)
+        last_used = os.path.getmtime(stamp if os.path.exists(stamp) else path)
+        mirrors.append((last_used, path, _dir_size(path)))
+    mirrors.sort()  # oldest first
+
+    total = sum(size for _, _, size in mirrors)
+    cutoff = time.time() - max_age_days * 86400
+    evicted = []
+    for last_used, path, size in mirrors:
+        if last_used >= cutoff and total <= max_bytes:
+            break
+        if _mirror_in_use(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted.append(path)
+    if evicted:
+        print(f"🧹 Evicted {len(evicted)} git mirror(s) from {root}")
+    return evicted
 
 
 class CodeRAG:
     """
     RAG System for Code Analysis
     """
-    def __init__(self, repo_url: str, model_name: str = "mistral"):
+    def __init__(self, repo_url: str, model_name: str = "mistral", embed_batch_size: int = None,
+                 use_embedding_cache: bool = True, ingest_workers: int = None, reranker_backend: str = "auto",
+                 semantic_answer_cache: bool = True, context_tokens: int = CONTEXT_TOKEN_BUDGET,
+                 shallow_clone: bool = True, ref: str = None, use_mirror: bool = True, max_file_bytes: int = None):
         self.repo_url = repo_url
         self.repo_name = repo_url.split("/")[-1].replace(".git", "")
+        self.shallow_clone = shallow_clone
+        self.ref = ref  # Branch, tag or full commit SHA to index instead of the default branch
+        self.use_mirror = use_mirror  # Check out from a local bare mirror instead of cloning ⚡
+        # Size cap for indexed files (None = FileSelector's defaults); large files are chunked as a stream
+        self.max_file_bytes = max_file_bytes
         # Use absolute paths for robust storage in the new workspace
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
         self.repo_path = os.path.join(self.base_dir, "repo_data", self.repo_name)
         self.vector_store_path = os.path.join(self.base_dir, "vector_store", self.repo_name)
         
-        self.embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
+        # Shared across repos, so vendored code and forks are only embedded once ⚡
+        self.embedding_cache = get_embedding_cache(os.path.join(self.base_dir, "embedding_cache")) if use_embedding_cache else None
         self.model_name = model_name
-        self.cache = {}  # Added for speed optimization ⚡
-        # Initialize reranker
-        self.reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2') 
+        self.embed_batch_size = embed_batch_size  # None = size batches automatically
+        self.ingest_workers = ingest_workers or os.cpu_count() or 1
+        self.ingest_stats = {}
+        self.skip_report = {}  # reason -> {"count", "examples"} from the last file selection
+        # Answers are cached on disk per repo (see AnswerCache) ⚡
+        self.semantic_answer_cache = semantic_answer_cache
+        self.last_response = {}  # result, metrics and sources of the latest ask_question
+        self.context_packer = ContextPacker(context_tokens)
+        # Ollama conversation state carried between chat turns (see ask_question)
+        self.chat_session = {"model": None, "context": None, "turns": 0}
+        # Models come from the process-wide registry, loaded on first use
+        self.reranker_backend = reranker_backend
         # Phase 2 State
         self.bm25 = None
+        self.bm25_vocab = {}
         self.all_chunks = []
+        # Server-side hybrid search state
+        self.sparse_encoder = SparseEncoder()
+        self.term_stats = None
+        self._readme_cache = None
+        self._aliases = None  # chunk id -> other files containing the chunk (see Deduplicator)
         
         # Phase 3 State
         self.history_path = os.path.join(self.repo_path, ".chat_history.json")
         
+    @property
+    def embeddings(self):
+        return get_embeddings()
+
+    @property
+    def reranker(self) -> Reranker:
+        return get_reranker(self.reranker_backend)
+
     def _remove_readonly(self, func, path, excinfo):
         """Helper to remove read-only files on Windows."""
         import stat
@@ -77,83 +2073,410 @@ class CodeRAG:
         
         os.makedirs(self.repo_path, exist_ok=True)
         
+        if self.use_mirror:
+            try:
+                self._checkout_from_mirror()
+                return f"Cloned {self.repo_name} successfully (local mirror)."
+            except Exception as e:
+                print(f"Mirror checkout failed ({e}). Falling back to a direct clone.")
+                shutil.rmtree(self.repo_path, onerror=self._remove_readonly)
+                os.makedirs(self.repo_path, exist_ok=True)
+        
         print(f"Cloning {self.repo_url} into {self.repo_path}...")
-        git.Repo.clone_from(self.repo_url, self.repo_path)
+        if self.shallow_clone:
+            try:
+                self._shallow_clone()
+                return f"Cloned {self.repo_name} successfully."
+            except Exception as e:
+                # e.g. git < 2.27 or a server without partial clone support
+                print(f"Shallow clone failed ({e}). Falling back to a full clone.")
+                shutil.rmtree(self.repo_path, onerror=self._remove_readonly)
+                os.makedirs(self.repo_path, exist_ok=True)
+        
+        repo = git.Repo.clone_from(self.repo_url, self.repo_path)
+        if self.ref:
+            repo.git.checkout(self.ref)
         return f"Cloned {self.repo_name} successfully."
 
-    def load_and_process_files(self) -> List[Any]:
-        """Loads code files and splits them into chunks."""
-        # Supported extensions
-        extensions = ['py', 'js', 'java', 'ts', 'cpp', 'c', 'cs', 'go', 'rs', 'swift', 'kt', 'rb', 'php', 'html', 'css', 'md', 'json']
-        documents = []
+    def _pinned_commit(self) -> Optional[str]:
+        """The ref when it is a full commit SHA (fetched directly rather than as a branch)."""
+        return self.ref if self.ref and re.fullmatch(r"[0-9a-f]{40}", self.ref) else None
+
+    def _clone_options(self) -> List[str]:
+        """Depth and branch shared by direct shallow clones and mirrors."""
+        options = ["--depth=1", "--single-branch"]
+        if self.ref and not self._pinned_commit():
+            options.append(f"--branch={self.ref}")
+        return options
+
+    def _mirror_path(self) -> str:
+        """One bare mirror per repo URL (case and trailing .git / slash ignored)."""
+        url = self.repo_url.strip().rstrip("/").lower()
+        url = url[:-4] if url.endswith(".git") else url
+        digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.base_dir, MIRROR_DIR, f"{self.repo_name}-{digest}.git")
+
+    def _sync_mirror(self) -> str:
+        """
+        Creates or refreshes the bare mirror and returns the commit to check out.
+        Call with the mirror's lock held (see _checkout_from_mirror).
+        """
+        mirror = self._mirror_path()
+        if not os.path.exists(mirror):
+            print(f"Mirroring {self.repo_url} into {mirror}...")
+            options = ["--bare"] + (self._clone_options() if self.shallow_clone else [])
+            tmp = f"{mirror}.tmp-{os.getpid()}"
+            shutil.rmtree(tmp, ignore_errors=True)
+            try:
+                git.Repo.clone_from(self.repo_url, tmp, multi_options=options)
+                os.replace(tmp, mirror)  # a half-written mirror is never picked up
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        # git.Git rather than git.Repo: worktree-specific config can move core.bare
+        # into config.worktree, where GitPython no longer sees the mirror as bare
+        mirror_git = git.Git(mirror)
+        depth = ["--depth=1"] if self.shallow_clone else []
+        # Sessions share the mirror, so each fetches into its own ref rather than FETCH_HEAD
+        private_ref = f"refs/coderag/{os.getpid()}-{threading.get_ident()}-{time.time_ns()}"
+        mirror_git.fetch(*depth, "origin", f"+{self.ref or 'HEAD'}:{private_ref}")
+        try:
+            commit = mirror_git.rev_parse(f"{private_ref}^{{commit}}")  # tags peel to their commit
+        finally:
+            mirror_git.update_ref("-d", private_ref)
+        Path(mirror, MIRROR_STAMP).touch()
+        return commit
+
+    def _checkout_from_mirror(self):
+        """
+        ⚡ Checks out a worktree of the local mirror: only new commits come over
+        the network and the worktree shares the mirror's objects (nothing is copied).
+        """
+        mirror = self._mirror_path()
+        os.makedirs(os.path.dirname(mirror), exist_ok=True)
+        # One session at a time creates, fetches into or adds worktrees to a mirror:
+        # git's own lock files make concurrent (shallow) fetches fail rather than wait
+        with _file_lock(f"{mirror}.lock"):
+            commit = self._sync_mirror()
+            mirror_git = git.Git(mirror)
+            mirror_git.worktree("prune")  # drop worktrees whose directory was deleted
+            # The full tree is checked out: the UI browses and zips every file, not just indexed ones
+            mirror_git.worktree("add", "--detach", self.repo_path, commit)
+        evict_mirrors(os.path.dirname(mirror))
+
+    def _shallow_clone(self):
+        """
+        ⚡ Fetches as little history as possible: depth 1 on a single branch. The working
+        tree is complete (the UI browses and zips it); FileSelector decides what gets indexed.
+        """
+        options = self._clone_options() + ["--no-checkout"]
+        repo = git.Repo.clone_from(self.repo_url, self.repo_path, multi_options=options)
+        if self._pinned_commit():
+            repo.git.fetch("--depth=1", "origin", self.ref)
+            repo.git.checkout(self.ref)
+        else:
+            repo.git.checkout(repo.active_branch.name)
+
+    def _iter_source_files(self):
+        """Yields the paths of every indexable file in the repository, in a stable order."""
+        # Vendored, ignored, generated, huge and binary files never reach the splitter ⚡
+        self.file_selector = FileSelector(self.repo_path, max_bytes=self.max_file_bytes)
+        yield from self.file_selector.walk()
+        self.skip_report = self.file_selector.report()
+        print(self.file_selector.summary())
+
+    def _split_files(self, file_paths):
+        """
+        Loads the given files and yields (source, chunks) per file, or per window of
+        a large file, in input order. Small files are sharded across worker processes.
+        """
+        file_paths = list(file_paths)
+        workers = min(self.ingest_workers, len(file_paths))
+        if len(file_paths) < PARALLEL_MIN_FILES:
+            workers = 1
         
+        loaded, chunks, last = 0, 0, None
+        for file_path, texts in _split_stream(file_paths, workers):
+            if file_path != last:
+                loaded += 1
+                last = file_path
+            chunks += len(texts)
+            yield file_path, texts
+        print(f"Loaded {loaded} documents.")
+        print(f"Split into {chunks} chunks.")
+
+    def load_and_process_files(self) -> List[Any]:
+        """
+        Loads code files and splits them into deduplicated chunks, in memory only.
+        Indexing (corpus, dedupe state and vectors) is done by ingest().
+        """
         print(f"Scanning {self.repo_path}...")
-        
-        for root, dirs, files in os.walk(self.repo_path):
-            # Skip hidden dirs
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-            
-            for file in files:
-                ext = file.split('.')[-1]
-                if ext in extensions:
-                    file_path = os.path.join(root, file)
-                    try:
-                        loader = TextLoader(file_path, encoding='utf-8')
-                        documents.extend(loader.load())
-                    except Exception as e:
-                        # Fallback for encoding issues
-                        pass
+        dedupe = Deduplicator()
+        chunks = []
+        for source, texts in self._split_files(self._iter_source_files()):
+            chunks.extend(_chunk_document(chunk_id, source, text, start, tokens)
+                          for chunk_id, start, tokens, text in dedupe.unique(source, texts, len(chunks)))
+        if dedupe.stats:
+            print("Deduplicated: " + ", ".join(f"{count} {kind}" for kind, count in dedupe.stats.items()))
+        return chunks
+
+    def _load_corpus(self) -> bool:
+        """Attaches the persisted chunk corpus and BM25 index (Phase 2 Hybrid Search)."""
+        corpus = load_corpus(self.vector_store_path)
+        if corpus is None:
+            return False
+        self.all_chunks, self.bm25, self.bm25_vocab = corpus
+        return True
 
-        print(f"Loaded {len(documents)} documents.")
+    def _embedding_batch_size(self, chunks) -> int:
+        """Returns the configured batch size, or one derived from the average chunk length."""
+        if self.embed_batch_size:
+            return self.embed_batch_size
+        avg_chars = sum(len(c.page_content) for c in chunks) / max(len(chunks), 1)
+        size = int(EMBED_BATCH_CHARS // max(avg_chars, 1))
+        size = max(MIN_EMBED_BATCH, min(MAX_EMBED_BATCH, size))
+        return 1 << (size.bit_length() - 1)  # Round down to a power of two
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """Embeds a list of texts with one batched call into the sentence-transformers model."""
+        model = getattr(self.embeddings, "client", None)
+        if model is not None and hasattr(model, "encode"):
+            vectors = model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+        else:
+            vectors = self.embeddings.embed_documents(texts)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def _embed_texts(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """Embeds texts, only running the model for those missing from the embedding cache."""
+        if self.embedding_cache is None:
+            return self._encode(texts, batch_size)
         
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", " ", ""]
+        keys = [self.embedding_cache.key(t) for t in texts]
+        cached = self.embedding_cache.get_many(keys)
+        missing = [i for i in range(len(texts)) if i not in cached]
+        if missing:
+            fresh = self._encode([texts[i] for i in missing], batch_size)
+            self.embedding_cache.put_many([keys[i] for i in missing], fresh)
+            cached.update(zip(missing, fresh))
+        return np.stack([cached[i] for i in range(len(texts))])
+
+    def _collection(self):
+        """Returns the shared Endee handle; new indexes get room for BM25 sparse vectors."""
+        return get_collection(self.repo_name, local_path=self.vector_store_path, sparse_dim=SPARSE_DIM)
+
+    def _insert_batch(self, db, offset, batch, vectors):
+        """Inserts one embedded batch of chunks into Endee with a single bulk request."""
+        sparse = None
+        if db.sparse_dim and not db.local_mode:
+            sparse = [self.sparse_encoder.encode_document(chunk.page_content) for chunk in batch]
+        db.insert_many(
+            ids=[chunk.metadata.get("chunk_id", f"chunk_{offset + i}") for i, chunk in enumerate(batch)],
+            vectors=vectors,
+            metadatas=[{
+                "source": chunk.metadata.get("source", "unknown"),
+                "content": chunk.page_content,
+                # Used by ContextPacker to merge neighbouring chunks and fit the token budget
+                **{key: chunk.metadata[key] for key in ("start", "tokens") if chunk.metadata.get(key) is not None}
+            } for chunk in batch],
+            batch_size=INSERT_BATCH_SIZE,
+            sparse=sparse
         )
-        chunks = text_splitter.split_documents(documents)
-        print(f"Split into {len(chunks)} chunks.")
+
+    def ingest(self) -> Dict[str, Any]:
+        """
+        Streams the repository into Endee and the saved corpus through IngestPipeline,
+        keeping memory flat regardless of repo size. Returns per-stage throughput.
+        """
+        print(f"Streaming {self.repo_path} into Endee collection: {self.repo_name}...")
+        db = self._collection()
+        self._clear_index_state()
+        db.reset()  # Re-ingestion replaces whatever was indexed before
+        started_local = db.local_mode
+        self.sparse_encoder = SparseEncoder()
+        writer = CorpusWriter(self.vector_store_path)
+        pipeline = IngestPipeline(self, db, writer)
+        try:
+            self.ingest_stats = pipeline.run()
+            self.ingest_stats["skipped"] = self.skip_report
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        pipeline.dedupe.save(self.vector_store_path)
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
         
-        # Initialize BM25 for Phase 2 Hybrid Search
-        print("Initializing BM25 index...")
-        tokenized_corpus = [re.sub(r'[^\w\s]', '', chunk.page_content.lower()).split() for chunk in chunks]
-        self.bm25 = BM25Okapi(tokenized_corpus)
-        self.all_chunks = chunks
+        # The new corpus is attached lazily by the next query
+        self.bm25, self.bm25_vocab, self.all_chunks = None, {}, []
+        self.term_stats, self._readme_cache, self._aliases = None, None, None
+        if db.local_mode != started_local:
+            # The server failed partway: the vectors are split across both stores
+            print("⚠️ Endee fell back to the local store mid-ingest; re-ingesting locally.")
+            return self.ingest()
+        self._write_index_state(commit=self._head_commit(), next_chunk=pipeline.next_chunk,
+                                sparse=self.sparse_encoder.state(), local=db.local_mode)
         
-        return chunks
+        print(f"Ingested {self.ingest_stats['chunks']} chunks in {self.ingest_stats['seconds']}s "
+              f"({self.ingest_stats['chunks_per_sec']} chunks/sec)")
+        if pipeline.dedupe.stats:
+            print("  Deduplicated: " + ", ".join(f"{count} {kind}" for kind, count in pipeline.dedupe.stats.items()))
+        for name, stage in self.ingest_stats["stages"].items():
+            print(f"  {name:>6}: {stage['items']} items, {stage['busy_seconds']}s busy, {stage['items_per_sec']}/sec")
+        return self.ingest_stats
 
     def create_vector_store(self, chunks):
-        """Creates and indexes the Endee vector store."""
+        """
+        Creates and indexes the Endee vector store. Goes through ingest(), so the
+        corpus, dedupe state and index state always describe the same vectors;
+        `chunks` (from load_and_process_files) only says whether there is anything to index.
+        """
         if not chunks:
             print("No chunks to index.")
             return None
-            
-        print("Creating embeddings and indexing into Endee...")
-        db = EndeeDB(collection_name=self.repo_name)
-        
-        for i, chunk in enumerate(chunks):
-            # Using embedding model to generate vectors
-            vector = self.embeddings.embed_query(chunk.page_content)
-            db.insert(
-                id=f"chunk_{i}",
-                vector=vector,
-                metadata={
-                    "source": chunk.metadata.get("source", "unknown"),
-                    "content": chunk.page_content
-                }
-            )
-        print(f"Data ingested into Endee collection: {self.repo_name}")
-        return db
+        self.ingest()
+        return self._collection()
+
+    def _head_commit(self):
+        """Returns the checked-out commit of the local clone, if it is a git repository."""
+        try:
+            return git.Repo(self.repo_path).head.commit.hexsha
+        except Exception:
+            return None
+
+    def _read_index_state(self) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.vector_store_path, INDEX_STATE_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _clear_index_state(self):
+        """
+        Forgets the indexed commit and chunk fingerprints before the collection is
+        wiped, so an ingest that fails midway is redone in full by the next update.
+        """
+        get_answer_cache(self.vector_store_path).clear()
+        for name in (INDEX_STATE_FILE, DEDUPE_FILE):
+            try:
+                os.remove(os.path.join(self.vector_store_path, name))
+            except FileNotFoundError:
+                pass
+
+    def _write_index_state(self, **state):
+        # Answers cached against the previous index are stale now
+        get_answer_cache(self.vector_store_path).clear()
+        os.makedirs(self.vector_store_path, exist_ok=True)
+        with open(os.path.join(self.vector_store_path, INDEX_STATE_FILE), 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+
+    def update_index(self) -> str:
+        """
+        Fetches the latest commit and re-indexes only the files changed since the
+        last indexed commit. Falls back to a full ingest when there is no index yet.
+        """
+        state = self._read_index_state()
+        if not state.get("commit") or not self._load_corpus():
+            self.ingest()
+            return f"Indexed {self.repo_name} from scratch."
+        db = self._collection()
+        if state.get("local", db.local_mode) != db.local_mode:
+            # The index lives in the other store (e.g. the server is back after a local
+            # fallback), so a diff against it would leave the handle's store incomplete
+            self.ingest()
+            return f"Re-indexed {self.repo_name} into the {'local store' if db.local_mode else 'Endee server'}."
+
+        repo = git.Repo(self.repo_path)
+        # A shallow clone stays shallow; a pinned ref stays pinned
+        # (common_dir is the mirror for worktrees checked out from one)
+        depth = ["--depth=1"] if os.path.exists(os.path.join(repo.common_dir, "shallow")) else []
+        # A worktree fetches into the shared mirror, so it takes the mirror's lock too
+        mirror = self._mirror_path()
+        shared = os.path.realpath(repo.common_dir) == os.path.realpath(mirror)
+        with _file_lock(f"{mirror}.lock") if shared else contextlib.nullcontext():
+            repo.git.fetch(*depth, "origin", self.ref or "HEAD")
+            new_commit = repo.commit("FETCH_HEAD").hexsha
+        if new_commit == state["commit"]:
+            return f"{self.repo_name} is already indexed at {new_commit[:8]}."
+
+        diff = [line.split("\t", 1) for line in
+                repo.git.diff("--name-status", "--no-renames", state["commit"], new_commit).splitlines()]
+        repo.git.reset("--hard", new_commit)
+        if any(rel_path.rpartition("/")[2] in (".gitignore", ".gitattributes") for _, rel_path in diff):
+            # File selection rules changed, so unchanged files may enter or leave the index
+            self.ingest()
+            return f"Selection rules changed; re-indexed {self.repo_name} at {new_commit[:8]}."
+
+        # Files that are now skipped (e.g. grew past the size cap) leave the index
+        selector = FileSelector(self.repo_path, max_bytes=self.max_file_bytes)
+        changed, removed = [], []
+        for status, rel_path in diff:
+            if rel_path.split('.')[-1] in SUPPORTED_EXTENSIONS:
+                (changed if status != "D" and selector.accepts(rel_path) else removed).append(rel_path)
+        self.skip_report = selector.report()
+
+        # Sources are stored exactly as the directory walk builds them
+        to_source = lambda rel_path: os.path.join(self.repo_path, *rel_path.split("/"))
+        touched = set()
+        dedupe = Deduplicator.load(self.vector_store_path)
+        pending = {to_source(p) for p in changed + removed}
+        while pending:
+            touched |= pending
+            # Unchanged copies that were only stored as aliases of changed chunks are indexed again
+            orphans = set(dedupe.forget(pending)) - touched
+            for source in sorted(orphans):
+                rel_path = os.path.relpath(source, self.repo_path).replace(os.sep, "/")
+                if os.path.exists(source) and selector.accepts(rel_path):
+                    changed.append(rel_path)
+            pending = orphans
+        started_local = db.local_mode
+        # Raises if the old vectors stay on the server; the index state is then left at
+        # the old commit, so the next update retries the same diff
+        db.delete_by_source(sorted(touched))
+
+        # Unchanged chunks are copied over; changed files stream through the ingest
+        # pipeline into the same corpus, so memory stays flat however large they are
+        self.sparse_encoder = SparseEncoder(*state.get("sparse", [0, 0]))
+        writer = CorpusWriter(self.vector_store_path)
+        for chunk in self.all_chunks:
+            if chunk.metadata.get("source") not in touched:
+                writer.add(chunk.metadata["chunk_id"], chunk.metadata.get("source", "unknown"), chunk.page_content,
+                           chunk.metadata.get("start"), chunk.metadata.get("tokens"))
+        pipeline = IngestPipeline(self, db, writer, sources=[to_source(p) for p in changed], dedupe=dedupe,
+                                  first_chunk=state.get("next_chunk", len(self.all_chunks)))
+        try:
+            stats = pipeline.run()
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
+        if db.local_mode != started_local:
+            # Unchanged files stayed on the server while the changed ones went local
+            print("⚠️ Endee fell back to the local store mid-update; re-ingesting locally.")
+            self.ingest()
+            return f"Re-indexed {self.repo_name} into the local store."
+        self.term_stats, self._readme_cache, self._aliases = None, None, None
+        self._load_corpus()
+        dedupe.save(self.vector_store_path)
+        self._write_index_state(commit=new_commit, next_chunk=pipeline.next_chunk,
+                                sparse=self.sparse_encoder.state(), local=db.local_mode)
+        return (f"Re-indexed {len(changed)} changed and {len(removed)} removed files "
+                f"({stats['chunks']} new chunks) at {new_commit[:8]}.")
+
 
     def load_vector_store(self):
-        """Initializes the Endee database client."""
-        # EndeeDB initialization handles collection checking
-        db = EndeeDB(collection_name=self.repo_name)
+        """Returns the shared Endee collection handle."""
+        # The handle verifies the collection once per process
+        db = self._collection()
         
-        # Reload BM25 if chunks are available in repo_path
-        if not self.bm25 and os.path.exists(self.repo_path):
-            print("Reloading BM25 from repo files...")
-            self.load_and_process_files()
+        if not db.local_mode and db.sparse_dim:
+            # 🚀 Keyword scoring happens in Endee; only per-term IDFs are needed here
+            if self.term_stats is None:
+                self.term_stats = load_term_stats(self.vector_store_path)
+        # Otherwise attach the BM25 corpus saved at ingestion time
+        elif not self.bm25 and not self._load_corpus():
+            print(f"No saved corpus for {self.repo_name}; keyword search disabled until the repo is re-analyzed.")
             
         return db
 
@@ -244,44 +2567,122 @@ class CodeRAG:
                 print(f"Failed to load history: {e}")
         return []
 
-    def _hybrid_search(self, db, query_vector, query_text, top_k=5):
-        """Combines Vector search (Endee) and Keyword search (BM25)."""
-        # 1. Vector Search
-        vector_results = db.search(vector=query_vector, top_k=top_k)
+    def _server_hybrid(self, db) -> bool:
+        """True when Endee fuses dense and BM25 sparse rankings itself."""
+        return bool(not db.local_mode and db.sparse_dim and self.term_stats is not None)
+
+    def _vector_search(self, db, query_vector, query_text, top_k=5):
+        """Endee search as (doc, fused score) pairs, scored by reciprocal-rank fusion."""
+        # 🚀 Server-side hybrid: one Endee call fuses dense and BM25 sparse rankings
+        server_hybrid = self._server_hybrid(db)
+        if server_hybrid:
+            sparse_indices, sparse_values = SparseEncoder.encode_query(query_text, self.term_stats)
+            vector_results = db.search(vector=query_vector, top_k=top_k * 2,
+                                       sparse_indices=sparse_indices, sparse_values=sparse_values)
+        else:
+            vector_results = db.search(vector=query_vector, top_k=top_k)
         
         # Convert Endee results to LangChain-like Document objects
-        try:
-            from langchain_core.documents import Document
-        except ImportError:
-            from langchain.schema import Document
-            
-        docs = []
-        for res in vector_results.get("matches", []):
-            docs.append(Document(
-                page_content=res.get("metadata", {}).get("content", ""),
-                metadata=res.get("metadata", {})
-            ))
-            
-        # 2. BM25 Search (Keyword)
-        if self.bm25:
-            tokenized_query = re.sub(r'[^\w\s]', '', query_text.lower()).split()
-            bm25_hits = self.bm25.get_top_n(tokenized_query, self.all_chunks, n=top_k)
-            
-            # Combine and deduplicate (by source and snippet)
-            seen_content = {d.page_content for d in docs}
-            for hit in bm25_hits:
-                if hit.page_content not in seen_content:
-                    docs.append(hit)
-                    seen_content.add(hit.page_content)
+        hits = []
+        for rank, res in enumerate(vector_results.get("matches", [])):
+            metadata = dict(res.get("metadata", {}), chunk_id=res.get("id"))
+            doc = Document(page_content=metadata.get("content", ""), metadata=metadata)
+            # The server already returns RRF scores for hybrid queries
+            hits.append((doc, res.get("score", 0.0) if server_hybrid else 1.0 / (RRF_K + rank + 1)))
+        return hits
+
+    def _keyword_search(self, query_text, top_k=5) -> List[Any]:
+        """Local BM25 hits, best first."""
+        if not self.bm25:
+            return []
+        tokenized_query = [self.bm25_vocab.get(token, -1) for token in _tokenize(query_text)]
+        return [self.all_chunks[i] for i in self.bm25.top_n(tokenized_query, n=top_k)]
+
+    def _merge_results(self, vector_hits, keyword_hits, query_text, top_k=5, with_scores=False):
+        """Adds keyword hits to the vector hits (fusing their ranks) and applies the README boost."""
+        docs = [doc for doc, _ in vector_hits]
+        fused = {doc.page_content: score for doc, score in vector_hits}  # page_content -> fused score
+
+        # Combine and deduplicate (by source and snippet)
+        seen_content = {d.page_content for d in docs}
+        for rank, hit in enumerate(keyword_hits):
+            if hit.page_content not in seen_content:
+                docs.append(hit)
+                seen_content.add(hit.page_content)
+            fused[hit.page_content] = fused.get(hit.page_content, 0.0) + 1.0 / (RRF_K + rank + 1)
                     
-        # 3. README Boost: If not present, look for it explicitly
+        # README Boost: If not present, look for it explicitly
         if "readme" in query_text.lower() or len(docs) < 2:
-            readme_docs = [c for c in self.all_chunks if "readme.md" in c.metadata.get("source", "").lower()]
-            for r in readme_docs[:2]:
+            boost = max(fused.values(), default=1.0 / (RRF_K + 1))
+            for r in self._readme_chunks()[:2]:
                 if r.page_content not in {d.page_content for d in docs}:
                     docs.insert(0, r)
+                    fused[r.page_content] = boost
                     
-        return docs[:top_k * 2] # Return more for the reranker
+        docs = docs[:top_k * 2] # Return more for the reranker
+        aliases = self._chunk_aliases()
+        for doc in docs:
+            if doc.metadata.get("chunk_id") in aliases:
+                doc.metadata["aliases"] = aliases[doc.metadata["chunk_id"]]
+        if with_scores:
+            return [(d, fused[d.page_content]) for d in docs]
+        return docs
+
+    def _hybrid_search(self, db, query_vector, query_text, top_k=5, with_scores=False):
+        """
+        Combines Vector search (Endee) and Keyword search (BM25).
+        With with_scores, returns (doc, fused score) pairs scored by reciprocal-rank fusion.
+        """
+        vector_hits = self._vector_search(db, query_vector, query_text, top_k)
+        keyword_hits = [] if self._server_hybrid(db) else self._keyword_search(query_text, top_k)
+        return self._merge_results(vector_hits, keyword_hits, query_text, top_k, with_scores)
+
+    async def retrieve_async(self, db, query: str, top_k=5):
+        """
+        Hybrid retrieval with the stages overlapped: query embedding followed by the
+        Endee round trip runs alongside local BM25 scoring, both on the retrieval
+        thread pool. Returns (query vector, [(doc, fused score), ...]).
+        """
+        loop = asyncio.get_running_loop()
+
+        async def vector_branch():
+            query_vector = await loop.run_in_executor(_RETRIEVAL_POOL, lambda: self._embed_texts([query])[0].tolist())
+            hits = await loop.run_in_executor(_RETRIEVAL_POOL, self._vector_search, db, query_vector, query, top_k)
+            return query_vector, hits
+
+        async def keyword_branch():
+            if self._server_hybrid(db):
+                return []
+            return await loop.run_in_executor(_RETRIEVAL_POOL, self._keyword_search, query, top_k)
+
+        (query_vector, vector_hits), keyword_hits = await asyncio.gather(vector_branch(), keyword_branch())
+        return query_vector, self._merge_results(vector_hits, keyword_hits, query, top_k, with_scores=True)
+
+    def retrieve(self, db, query: str, top_k=5):
+        """Sync wrapper around retrieve_async for the generator API (and Streamlit's script thread)."""
+        return _run_sync(self.retrieve_async(db, query, top_k))
+
+    def _chunk_aliases(self) -> Dict[str, List[str]]:
+        """Other files each deduplicated chunk appears in, so hits can name every copy."""
+        if self._aliases is None:
+            self._aliases = Deduplicator.load(self.vector_store_path).aliases
+        return self._aliases
+
+    def _readme_chunks(self) -> List[Any]:
+        """README chunks from the loaded corpus, or streamed from disk when it isn't loaded."""
+        if self.all_chunks:
+            return [c for c in self.all_chunks if "readme.md" in c.metadata.get("source", "").lower()]
+        if self._readme_cache is None:
+            self._readme_cache = load_readme_chunks(self.vector_store_path)
+        return self._readme_cache
+
+    @staticmethod
+    def _source_label(doc) -> str:
+        label = os.path.basename(doc.metadata.get('source', 'unknown'))
+        aliases = doc.metadata.get("aliases")
+        if aliases:
+            label += " (also in " + ", ".join(os.path.basename(a) for a in aliases[:3]) + ("..." if len(aliases) > 3 else "") + ")"
+        return label
 
     def _clean_code(self, content: str) -> str:
         """Removes excessive whitespace and common comment patterns to save tokens."""
@@ -294,9 +2695,17 @@ class CodeRAG:
         lines = [line.strip() for line in content.split('\n') if line.strip()]
         return "\n".join(lines)
 
-    def ask_question(self, query: str) -> Generator[str, None, None]:
-        """Queries the RAG system with streaming and metrics."""
+    def reset_chat_session(self):
+        """Starts the next question in a fresh Ollama conversation."""
+        self.chat_session = {"model": None, "context": None, "turns": 0}
+
+    def ask_question(self, query: str, chat_session: bool = True) -> Generator[str, None, None]:
+        """
+        Queries the RAG system with streaming and metrics. In a chat session, follow-up
+        questions continue Ollama's previous context instead of prefilling it again.
+        """
         start_time = time.time()
+        self.last_response = {}
         
         db = self.load_vector_store()
         if not db:
@@ -305,47 +2714,61 @@ class CodeRAG:
 
         # 1. Search Time
         search_start = time.time()
-        query_vector = self.embeddings.embed_query(query)
-        
-        # 🚀 Phase 2: Hybrid Search
-        docs = self._hybrid_search(db, query_vector, query)
+        # 🚀 Phase 2: Hybrid Search (vector and keyword searches run concurrently)
+        query_vector, scored_docs = self.retrieve(db, query)
         
         # 2️⃣ Add a Reranker (Improves Speed + Quality) ⚡
-        if docs:
-            pairs = [[query, doc.page_content] for doc in docs]
-            scores = self.reranker.predict(pairs)
-            scored_docs = sorted(zip(scores, docs), key=lambda x: x[0], reverse=True)
-            # Keep top 3 for better context
-            docs = [doc for score, doc in scored_docs[:3]]
+        # Cached scores and clear winners skip the cross-encoder
+        docs = self.reranker.rerank(query, scored_docs, keep=CONTEXT_CANDIDATES)
+        # ⚡ Fewer prompt tokens = faster prefill: merge overlapping chunks and fit the token budget
+        docs = self.context_packer.pack(docs)
 
         search_time = round(time.time() - search_start, 2)
         
+        # Clean documents content to save tokens (packed spans are fresh copies of the shared chunks)
+        for doc in docs:
+            doc.page_content = self._clean_code(doc.page_content)
+
+        # 🚀 Follow-ups continue the previous turn's KV context instead of prefilling it again
+        session = self.chat_session
+        if not chat_session or session["model"] != self.model_name or \
+                len(session["context"] or []) > OLLAMA_SESSION_MAX_TOKENS:
+            session = {"model": self.model_name, "context": None, "turns": 0}
+
+        # ⚡ Answer cache: the same question over the same indexed chunks skips the LLM.
+        # A follow-up's answer depends on the conversation so far, so it is never cached.
+        answer_cache = get_answer_cache(self.vector_store_path) if not session["context"] else None
+        if answer_cache is not None:
+            scope, cache_key = answer_cache.key(self._read_index_state().get("commit"), self.model_name,
+                                                [cid for d in docs for cid in d.metadata["chunk_ids"]], query)
+            cached = answer_cache.get(scope, cache_key, query_vector if self.semantic_answer_cache else None)
+            if cached is not None:
+                if chat_session:
+                    # Ollama never saw this turn, so the conversation still has no context
+                    self.chat_session = {"model": self.model_name, "context": None, "turns": session["turns"] + 1}
+                metrics = {"search_time": search_time, "llm_time": 0.0,
+                           "session_turn": session["turns"] + 1 if chat_session else None,
+                           "total_time": round(time.time() - start_time, 2), "cached": True}
+                self.last_response = {"result": cached, "metrics": metrics, "source_documents": docs}
+                yield cached
+                return
+
         try:
-            llm = Ollama(model=self.model_name, base_url="http://127.0.0.1:11434")
-            
-            # Clean documents content to save tokens
-            for doc in docs:
-                doc.page_content = self._clean_code(doc.page_content)
+            # Context construction: the stable instructions live in SYSTEM_PROMPT, the question goes last
+            context_text = "\n\n".join([f"Source: {self._source_label(d)}\nCode:\n{d.page_content}" for d in docs])
+            prompt = f"Code Context:\n{context_text}\n\nQuestion: {query}\n\nAnswer:"
 
-            # Context construction
-            context_text = "\n\n".join([f"Source: {os.path.basename(d.metadata.get('source', 'unknown'))}\nCode:\n{d.page_content}" for d in docs])
-            
-            prompt = f"""You are a professional coding assistant. Use the following code snippets to answer the user's question. 
-            Detailed and accurate answers are prioritized. If you don't know, say so.
-            
-            Question: {query}
-            
-            Code Context:
-            {context_text}
-            
-            Answer:"""
-            
             # Streaming and total tokens
             llm_start = time.time()
             full_response = ""
-            for chunk in llm.stream(prompt):
+            stats = {}
+            for chunk in get_ollama_client().generate(self.model_name, prompt, system=SYSTEM_PROMPT,
+                                                      context=session["context"], stats=stats):
                 full_response += chunk
                 yield chunk
+            if chat_session:
+                self.chat_session = {"model": self.model_name, "context": stats.get("context"),
+                                     "turns": session["turns"] + 1}
             
             llm_time = round(time.time() - llm_start, 2)
             total_time = round(time.time() - start_time, 2)
@@ -354,12 +2777,18 @@ class CodeRAG:
             metrics = {
                 "search_time": search_time,
                 "llm_time": llm_time,
+                "ttft": stats.get("ttft"),
+                "prefill_tokens": stats.get("prompt_eval_count"),
+                "session_turn": session["turns"] + 1 if chat_session else None,
                 "total_time": total_time,
+                "context_tokens": sum(d.metadata["tokens"] for d in docs),
                 "source_documents": docs
             }
             
             # Save to cache with metrics
-            self.cache[query] = {"result": full_response, "metrics": metrics, "source_documents": docs}
+            self.last_response = {"result": full_response, "metrics": metrics, "source_documents": docs}
+            if answer_cache is not None:
+                answer_cache.put(scope, cache_key, full_response, query_vector)
             
         except Exception as e:
             if "connection" in str(e).lower() or "refused" in str(e).lower():
@@ -2,48 +2,336 @@ import requests
 import json
 import msgpack
 import os
+import threading
+import time
 import numpy as np
 
+# Process-wide collection handles: (base_url, collection_name) -> EndeeDB
+_COLLECTIONS = {}
+_COLLECTIONS_LOCK = threading.Lock()
+# A handle that fell back to local mode is rebuilt (re-probing the server) after this long
+LOCAL_MODE_RETRY_SECONDS = 30
+
+
+def get_collection(collection_name, base_url="http://localhost:8080", token=None, local_path=None, sparse_dim=0):
+    """
+    Returns the shared EndeeDB handle for a collection. The index is verified (and
+    created if missing) only when the handle is first built; later calls are free.
+    A handle in local fallback mode is replaced after LOCAL_MODE_RETRY_SECONDS, so a
+    server that was down or briefly failing is used again once it is back, unless
+    it has written to the local store since: those vectors exist nowhere else, so
+    the handle stays local until the process ends (see CodeRAG.update_index).
+    `sparse_dim` only applies when the index has to be created.
+    """
+    key = (base_url.rstrip('/'), collection_name)
+    with _COLLECTIONS_LOCK:
+        db = _COLLECTIONS.get(key)
+        if (db is not None and db.local_mode and not db.local_writes
+                and time.monotonic() - db.local_since >= LOCAL_MODE_RETRY_SECONDS):
+            local_path = local_path or db.local_path
+            db = None
+        if db is None:
+            db = EndeeDB(collection_name, base_url=base_url, token=token, local_path=local_path, sparse_dim=sparse_dim)
+            _COLLECTIONS[key] = db
+        elif local_path and not db.local_path:
+            db.local_path = local_path
+        return db
+
+
+def drop_collection_handle(collection_name, base_url="http://localhost:8080"):
+    """Forgets a cached handle so the next get_collection re-verifies the index."""
+    with _COLLECTIONS_LOCK:
+        _COLLECTIONS.pop((base_url.rstrip('/'), collection_name), None)
+
+
+class LocalVectorStore:
+    """
+    Contiguous float32 store used by EndeeDB's local fallback mode.
+    Rows are L2-normalized on insert, so cosine search is a single matrix product.
+    Capacity grows by doubling to keep appends amortized O(1).
+
+    When `path` is given the matrix lives in a memory-mapped raw float32 file and
+    ids/metadata in an append-only msgpack log next to it, so reopening is zero-copy.
+    """
+    VECTORS_FILE = "local_vectors.f32"
+    INDEX_FILE = "local_index.msgpack"
+
+    def __init__(self, dim=None, initial_capacity=1024, path=None):
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self.path = path
+        self.count = 0
+        self.ids = []
+        self.metadata = []
+        self._id_to_row = {}
+        self._deleted = set()  # Tombstoned rows; storage is append-only
+        self._matrix = None
+        self._lock = threading.Lock()  # Handles are shared, so writers are serialized
+        if self.path:
+            self._load()
+
+    def __len__(self):
+        return self.count - len(self._deleted)
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.path, self.VECTORS_FILE)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.path, self.INDEX_FILE)
+
+    def _load(self):
+        """Replays the index log and maps the vector file without reading it."""
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, "rb") as f:
+            for record in msgpack.Unpacker(f, raw=False):
+                if isinstance(record, dict):
+                    self.dim = record["dim"]
+                    continue
+                row, id, metadata = record
+                if row == len(self.ids):
+                    self.ids.append(id)
+                    self.metadata.append(metadata)
+                else:
+                    self.metadata[row] = metadata
+                if metadata is None:
+                    self._deleted.add(row)
+                    if self._id_to_row.get(id) == row:
+                        del self._id_to_row[id]
+                else:
+                    self._id_to_row[id] = row
+        self.count = len(self.ids)
+
+        capacity = os.path.getsize(self._vectors_path) // (4 * self.dim) if os.path.exists(self._vectors_path) else 0
+        if capacity:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _append_log(self, records):
+        os.makedirs(self.path, exist_ok=True)
+        new_log = not os.path.exists(self._index_path)
+        with open(self._index_path, "ab") as f:
+            if new_log:
+                f.write(msgpack.packb({"dim": self.dim}))
+            for record in records:
+                f.write(msgpack.packb(record, use_bin_type=True))
+
+    def clear(self):
+        """Drops every vector, including the on-disk files."""
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._matrix = None
+        if self.path:
+            for file_path in (self._vectors_path, self._index_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        self.count = 0
+        self.ids, self.metadata, self._id_to_row = [], [], {}
+        self._deleted = set()
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _reserve(self, extra):
+        """Makes room for `extra` more rows, doubling capacity as needed."""
+        needed = self.count + extra
+        capacity = 0 if self._matrix is None else len(self._matrix)
+        if needed <= capacity:
+            return
+        capacity = max(capacity, self.initial_capacity)
+        while capacity < needed:
+            capacity *= 2
+
+        if self.path:
+            # Release the old mapping before resizing the file underneath it
+            if self._matrix is not None:
+                self._matrix.flush()
+                self._matrix = None
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._vectors_path, "r+b" if os.path.exists(self._vectors_path) else "w+b") as f:
+                f.truncate(capacity * self.dim * 4)
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+            return
+
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        if self.count:
+            grown[:self.count] = self._matrix[:self.count]
+        self._matrix = grown
+
+    def add(self, ids, vectors, metadatas=None):
+        """Adds vectors, overwriting rows whose id already exists."""
+        with self._lock:
+            self._add(ids, vectors, metadatas)
+
+    def _add(self, ids, vectors, metadatas):
+        ids = [str(i) for i in ids]
+        if not ids:
+            return
+        vectors = self._normalize(vectors)
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in ids]
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+
+        self._reserve(len(set(ids) - self._id_to_row.keys()))
+        rows = []
+        for id, metadata in zip(ids, metadatas):
+            row = self._id_to_row.get(id)
+            if row is None:
+                row = self.count
+                self.count += 1
+                self._id_to_row[id] = row
+                self.ids.append(id)
+                self.metadata.append(metadata or {})
+            else:
+                self.metadata[row] = metadata or {}
+            rows.append(row)
+        self._matrix[rows] = vectors
+
+        if self.path:
+            # Vectors hit the disk before the log entries that make them visible
+            self._matrix.flush()
+            self._append_log([row, id, self.metadata[row]] for row, id in zip(rows, ids))
+
+    def update_metadata(self, id, metadata):
+        with self._lock:
+            row = self._id_to_row.get(str(id))
+            if row is not None:
+                self.metadata[row] = metadata
+                if self.path:
+                    self._append_log([[row, str(id), metadata]])
+
+    def delete(self, ids):
+        """Tombstones the given ids; returns how many were present."""
+        with self._lock:
+            rows = [self._id_to_row.pop(str(id)) for id in ids if str(id) in self._id_to_row]
+            for row in rows:
+                self.metadata[row] = None
+            self._deleted.update(rows)
+            if rows and self.path:
+                self._append_log([row, self.ids[row], None] for row in rows)
+        return len(rows)
+
+    def search(self, vector, top_k):
+        return self.search_many([vector], top_k)[0]
+
+    def search_many(self, vectors, top_k):
+        """Cosine top-k for a batch of query vectors; returns one match list per query."""
+        queries = self._normalize(vectors)
+        count, matrix = self.count, self._matrix  # Snapshot; concurrent appends only add rows
+        if not count:
+            return [[] for _ in queries]
+
+        scores = queries @ matrix[:count].T
+        if self._deleted:
+            scores[:, [row for row in self._deleted if row < count]] = -np.inf
+        k = min(top_k, count)
+        if k < count:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(count), scores.shape)
+
+        results = []
+        for row_scores, candidates in zip(scores, top):
+            ordered = candidates[np.argsort(-row_scores[candidates], kind="stable")]
+            results.append([
+                {"id": self.ids[i], "score": float(row_scores[i]), "metadata": self.metadata[i]}
+                for i in ordered if row_scores[i] != -np.inf
+            ])
+        return results
+
+
 class EndeeDB:
     """
     A resilient Python client for the Endee Vector Database REST API.
     Includes a local fallback to ensure the application works even if the server is down.
+    Prefer get_collection() over constructing this directly, so handles are reused.
     """
-    def __init__(self, collection_name, base_url="http://localhost:8080", token=None):
+    def __init__(self, collection_name, base_url="http://localhost:8080", token=None, local_path=None, sparse_dim=0):
         self.collection_name = collection_name
         self.base_url = base_url.rstrip('/')
         self.token = token
         self.headers = {"Content-Type": "application/json"}
         if self.token:
             self.headers["Authorization"] = self.token
+        # Keep-alive connections for the lifetime of the handle
+        self.session = requests.Session()
+        # Filled from /info once the index is verified
+        self.dim = 384  # Default for all-MiniLM-L6-v2
+        self.space_type = "l2"
+        self.sparse_dim = sparse_dim  # > 0 when the index also stores sparse (keyword) vectors
+        # What the caller asked for; used whenever the index is (re)created, since
+        # sparse_dim above reflects the existing index's schema once /info answers
+        self.requested_sparse_dim = sparse_dim
         
-        # Local fallback storage
+        # Local fallback storage (persisted under local_path when given, opened on first use)
         self.local_mode = False
-        self.local_data = [] # List of {"id": id, "vector": vector, "metadata": metadata}
+        self.local_since = None  # when local mode was entered (see get_collection)
+        self.local_writes = False  # the local store was written to in local mode
+        self.local_path = local_path
+        self._local_store = None
         
         # Attempt to ensure the index exists, if it fails, switch to local mode
         self._ensure_index()
 
+    @property
+    def local_store(self):
+        if self._local_store is None:
+            self._local_store = LocalVectorStore(path=self.local_path)
+        return self._local_store
+
+    def _fall_back(self):
+        """Switches this handle to the local store; get_collection re-probes the server later."""
+        if not self.local_mode:
+            self.local_mode = True
+            self.local_since = time.monotonic()
+
     def _ensure_index(self):
         """Checks if the index exists, creates it if it doesn't. Errors switch to local mode."""
         try:
-            url = f"{self.base_url}/api/v1/index/create"
-            data = {
-                "index_name": self.collection_name,
-                "dim": 384,  # Default for all-MiniLM-L6-v2
-                "space_type": "l2"
-            }
             # Set a short timeout for the initial connection check
-            response = requests.post(url, json=data, headers=self.headers, timeout=2)
-            if response.status_code not in [200, 400, 409]: # 400/409 often mean already exists
-                print(f"Endee server returned {response.status_code}. Using local fallback mode.")
-                self.local_mode = True
+            info = self._index_info(timeout=2)
+            if info is None:
+                url = f"{self.base_url}/api/v1/index/create"
+                data = {
+                    "index_name": self.collection_name,
+                    "dim": self.dim,
+                    "space_type": self.space_type
+                }
+                if self.requested_sparse_dim:
+                    data["sparse_dim"] = self.requested_sparse_dim
+                response = self.session.post(url, json=data, headers=self.headers, timeout=2)
+                if response.status_code not in [200, 400, 409]: # 400/409 often mean already exists
+                    print(f"Endee server returned {response.status_code}. Using local fallback mode.")
+                    self._fall_back()
+                    return
+                info = self._index_info(timeout=2) or {}
+            self.dim = info.get("dimension", self.dim)
+            self.space_type = info.get("space_type", self.space_type)
+            self.sparse_dim = info.get("sparse_dim", self.requested_sparse_dim)
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
-            print("Endee server not found at localhost:8080. Using local fallback mode.")
-            self.local_mode = True
+            print(f"Endee server not found at {self.base_url}. Using local fallback mode.")
+            self._fall_back()
         except Exception as e:
             print(f"Connection error: {e}. Using local fallback mode.")
-            self.local_mode = True
+            self._fall_back()
+
+    def _index_info(self, timeout=5):
+        """Returns the index description from /info, or None if the index does not exist."""
+        url = f"{self.base_url}/api/v1/index/{self.collection_name}/info"
+        response = self.session.get(url, headers=self.headers, timeout=timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
 
     def insert(self, id, vector, metadata=None):
         """
@@ -51,11 +339,8 @@ class EndeeDB:
         Uses local fallback if the server is down.
         """
         if self.local_mode:
-            self.local_data.append({
-                "id": str(id),
-                "vector": vector,
-                "metadata": metadata or {}
-            })
+            self.local_writes = True
+            self.local_store.add([id], [vector], [metadata])
             return True
 
         try:
@@ -65,10 +350,10 @@ class EndeeDB:
                 "id": str(id),
                 "vector": vector
             }
-            response = requests.post(url, json=payload, headers=self.headers, timeout=5)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=5)
             if response.status_code != 200:
                 print(f"Insert failed: {response.text}. Attempting local fallback.")
-                self.local_mode = True
+                self._fall_back()
                 return self.insert(id, vector, metadata)
 
             # 2. Update metadata
@@ -77,15 +362,54 @@ class EndeeDB:
             return True
         except Exception as e:
             print(f"Insert failed with error: {e}. Attempting local fallback.")
-            self.local_mode = True
+            self._fall_back()
             return self.insert(id, vector, metadata)
 
+    def insert_many(self, ids, vectors, metadatas=None, batch_size=2000, sparse=None):
+        """
+        Inserts vectors in bulk, one msgpack request per batch of `batch_size`.
+        Metadata travels in the same request, so no separate filters/update call is needed.
+        `sparse` optionally gives an (indices, values) pair per vector for hybrid search.
+        Uses local fallback if the server is down.
+        """
+        ids = [str(i) for i in ids]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in ids]
+        sparse = list(sparse) if sparse is not None and self.sparse_dim else [([], []) for _ in ids]
+
+        if self.local_mode:
+            self.local_writes = True
+            self.local_store.add(ids, vectors, metadatas)
+            return True
+
+        url = f"{self.base_url}/api/v1/index/{self.collection_name}/vector/insert"
+        headers = dict(self.headers, **{"Content-Type": "application/msgpack"})
+        norms = np.linalg.norm(vectors, axis=1) if len(vectors) else []
+
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            # Field order mirrors ndd::HybridVectorObject: id, meta, filter, norm, vector, sparse_ids, sparse_values
+            batch = [
+                [ids[i], b"", json.dumps(metadatas[i] or {}), float(norms[i]), vectors[i].tolist(),
+                 list(sparse[i][0]), list(sparse[i][1])]
+                for i in range(start, min(end, len(ids)))
+            ]
+            try:
+                body = msgpack.packb(batch, use_bin_type=True, use_single_float=True)
+                response = self.session.post(url, data=body, headers=headers, timeout=30)
+                if response.status_code != 200:
+                    raise RuntimeError(f"status {response.status_code}: {response.text}")
+            except Exception as e:
+                print(f"Bulk insert failed with error: {e}. Attempting local fallback.")
+                self._fall_back()
+                return self.insert_many(ids[start:], vectors[start:], metadatas[start:], batch_size, sparse[start:])
+        return True
+
     def update_metadata(self, id, metadata):
         """Updates metadata. Handles fallback."""
         if self.local_mode:
-            for item in self.local_data:
-                if item["id"] == str(id):
-                    item["metadata"] = metadata
+            self.local_writes = True
+            self.local_store.update_metadata(id, metadata)
             return True
 
         try:
@@ -93,14 +417,60 @@ class EndeeDB:
             payload = {
                 "updates": [{"id": str(id), "filter": metadata}]
             }
-            requests.post(url, json=payload, headers=self.headers, timeout=5)
+            self.session.post(url, json=payload, headers=self.headers, timeout=5)
         except:
             pass # Non-critical if metadata update fails on server during ingestion
         return True
 
-    def search(self, vector, top_k=3):
+    def delete_by_source(self, sources):
         """
-        Performs similarity search. Uses local fallback if server is down.
+        Deletes every vector whose metadata `source` is one of `sources`. Raises
+        RuntimeError if the server can't delete them, since the vectors would go stale.
+        """
+        sources = list(sources)
+        if not sources:
+            return 0
+        if self.local_mode:
+            self.local_writes = True
+            wanted = set(sources)
+            store = self.local_store
+            return store.delete([id for id, md in zip(store.ids, store.metadata) if md and md.get("source") in wanted])
+
+        url = f"{self.base_url}/api/v1/index/{self.collection_name}/vectors/delete"
+        payload = {"filter": [{"source": {"$in": sources}}]}
+        try:
+            response = self.session.delete(url, json=payload, headers=self.headers, timeout=30)
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Delete failed with error: {e}") from e
+        if response.status_code != 200:
+            raise RuntimeError(f"Delete failed: {response.status_code} {response.text}")
+        try:
+            return int(response.text.split()[0])
+        except (ValueError, IndexError):
+            return 0
+
+    def reset(self):
+        """
+        Drops every vector in the collection, on the server and in the local fallback.
+        Raises RuntimeError if the server keeps the old index (new vectors would be mixed in).
+        """
+        self.local_store.clear()
+        if self.local_mode:
+            self.local_writes = True  # the server index is now stale, not just behind
+            return
+        url = f"{self.base_url}/api/v1/index/{self.collection_name}/delete"
+        try:
+            response = self.session.delete(url, headers=self.headers, timeout=10)
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError(f"Index reset failed with error: {e}") from e
+        if response.status_code not in (200, 404):  # 404: there was no index to drop
+            raise RuntimeError(f"Index reset failed: {response.status_code} {response.text}")
+        self._ensure_index()
+
+    def search(self, vector, top_k=3, sparse_indices=None, sparse_values=None):
+        """
+        Performs similarity search. With sparse query terms the server runs a hybrid
+        dense + sparse search and fuses both rankings. Uses local fallback if server is down.
         """
         if self.local_mode:
             return self._local_search(vector, top_k)
@@ -108,8 +478,11 @@ class EndeeDB:
         try:
             url = f"{self.base_url}/api/v1/index/{self.collection_name}/search"
             payload = {"vector": vector, "k": top_k}
+            if sparse_indices and self.sparse_dim:
+                payload["sparse_indices"] = list(sparse_indices)
+                payload["sparse_values"] = list(sparse_values)
             
-            response = requests.post(url, json=payload, headers=self.headers, timeout=5)
+            response = self.session.post(url, json=payload, headers=self.headers, timeout=5)
             if response.status_code != 200:
                 print(f"Search failed: {response.text}. Using local fallback.")
                 return self._local_search(vector, top_k)
@@ -118,10 +491,13 @@ class EndeeDB:
             matches = []
             results_list = []
             
+            # Results are a list of [similarity, id, meta, filter, norm, vector],
+            # possibly wrapped in a ResultSet
             if isinstance(data, dict) and 'results' in data:
                 results_list = data['results']
             elif isinstance(data, list) and len(data) > 0:
-                if isinstance(data[0], list): results_list = data[0]
+                nested = isinstance(data[0], list) and len(data[0]) > 0 and isinstance(data[0][0], list)
+                results_list = data[0] if nested else data
 
             for item in results_list:
                 if isinstance(item, list) and len(item) >= 4:
@@ -137,31 +513,15 @@ class EndeeDB:
             print(f"Search failed: {e}. Using local fallback.")
             return self._local_search(vector, top_k)
 
+    def search_many(self, vectors, top_k=3):
+        """
+        Searches several query vectors at once. The local fallback scores the whole
+        batch in one matrix product; the server is queried once per vector.
+        """
+        if self.local_mode:
+            return [{"matches": matches} for matches in self.local_store.search_many(vectors, top_k)]
+        return [self.search(vector, top_k) for vector in vectors]
+
     def _local_search(self, query_vector, top_k):
-        """Simple in-memory Cosine Similarity search using numpy."""
-        if not self.local_data:
-            return {"matches": []}
-            
-        q_vec = np.array(query_vector)
-        q_norm = np.linalg.norm(q_vec)
-        
-        results = []
-        for item in self.local_data:
-            i_vec = np.array(item["vector"])
-            i_norm = np.linalg.norm(i_vec)
-            
-            # Cosine similarity
-            if q_norm > 0 and i_norm > 0:
-                sim = np.dot(q_vec, i_vec) / (q_norm * i_norm)
-            else:
-                sim = 0
-                
-            results.append({
-                "id": item["id"],
-                "score": float(sim),
-                "metadata": item["metadata"]
-            })
-            
-        # Sort by score descending
-        results.sort(key=lambda x: x["score"], reverse=True)
-        return {"matches": results[:top_k]}
+        """Cosine similarity search over the local fallback store."""
+        return {"matches": self.local_store.search(query_vector, top_k)}
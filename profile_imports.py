@@ -0,0 +1,75 @@
+"""
+Startup import budget for the app, measured with `python -X importtime`.
+
+    python profile_imports.py                 # backend against the default budget
+    python profile_imports.py backend streamlit --budget 800 --top 15
+
+Each module is imported in a fresh interpreter (best of --runs). The report
+lists the slowest top-level packages, and the script exits non-zero when
+a module goes over budget or pulls in a heavy dependency that should load lazily.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+DEFAULT_MODULES = ["backend"]
+DEFAULT_BUDGET_MS = 500
+# Must not be imported until the stage that needs them (see backend._LazyImport)
+HEAVY_PACKAGES = ["torch", "transformers", "sentence_transformers", "langchain_community", "langchain", "git"]
+
+
+def import_times(module: str):
+    """Returns {module name: (self us, cumulative us)} for one cold import of module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def report(module: str, budget_ms: float, top: int, runs: int) -> bool:
+    try:
+        times = min((import_times(module) for _ in range(runs)), key=lambda t: t.get(module, (0, 0))[1])
+    except RuntimeError as e:
+        print(f"FAIL: import {module} -> {e}")
+        return False
+
+    total_ms = times.get(module, (0, 0))[1] / 1000
+    by_package = defaultdict(int)
+    for name, (self_us, _) in times.items():
+        by_package[name.split(".")[0]] += self_us
+
+    print(f"\n--- import {module}: {total_ms:.0f} ms (budget {budget_ms:.0f} ms) ---")
+    for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{self_us / 1000:8.1f} ms  {package}")
+
+    eager = [p for p in HEAVY_PACKAGES if p in by_package]
+    ok = total_ms <= budget_ms and not eager
+    if eager:
+        print(f"FAIL: heavy packages imported eagerly: {', '.join(eager)}")
+    if total_ms > budget_ms:
+        print(f"FAIL: {total_ms:.0f} ms is over the {budget_ms:.0f} ms budget")
+    if ok:
+        print("SUCCESS: within budget")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET_MS, help="cumulative import budget in ms")
+    parser.add_argument("--top", type=int, default=10, help="slowest packages to list")
+    parser.add_argument("--runs", type=int, default=3, help="imports per module; the fastest counts")
+    args = parser.parse_args()
+    results = [report(m, args.budget, args.top, args.runs) for m in args.modules]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,193 @@
+from unittest.mock import MagicMock, patch
+
+import msgpack
+import numpy as np
+
+import endee_client
+from endee_client import EndeeDB, LocalVectorStore, get_collection
+
+
+def make_db():
+    info = MagicMock(status_code=200, json=lambda: {"dimension": 4, "space_type": "l2"})
+    with patch("endee_client.requests.Session.get", return_value=info):
+        return EndeeDB(collection_name="test")
+
+
+def test_insert_many_packs_one_request_per_batch():
+    db = make_db()
+    vectors = np.random.rand(5, 4).astype(np.float32)
+    metadatas = [{"source": f"file_{i}.py"} for i in range(5)]
+
+    with patch.object(db.session, "post", return_value=MagicMock(status_code=200)) as post:
+        assert db.insert_many(range(5), vectors, metadatas, batch_size=2)
+
+    assert post.call_count == 3
+    assert post.call_args.kwargs["headers"]["Content-Type"] == "application/msgpack"
+    first = msgpack.unpackb(post.call_args_list[0].kwargs["data"], raw=False)
+    assert [obj[0] for obj in first] == ["0", "1"]
+    assert first[0][2] == '{"source": "file_0.py"}'
+    assert np.allclose(first[1][4], vectors[1])
+    print("✅ test_insert_many_packs_one_request_per_batch passed!")
+
+
+def test_hybrid_search_sends_sparse_terms_and_parses_results():
+    db = make_db()
+    db.sparse_dim = 1024
+    results = [[0.9, "chunk_1", b"", '{"source": "a.py"}', 1.0, []],
+               [0.4, "chunk_2", b"", '{"source": "b.py"}', 1.0, []]]
+    response = MagicMock(status_code=200, content=msgpack.packb(results))
+
+    with patch.object(db.session, "post", return_value=response) as post:
+        matches = db.search([0.1] * 4, top_k=2, sparse_indices=[3, 7], sparse_values=[1.5, 0.2])["matches"]
+
+    payload = post.call_args.kwargs["json"]
+    assert payload["sparse_indices"] == [3, 7] and payload["sparse_values"] == [1.5, 0.2]
+    assert [m["id"] for m in matches] == ["chunk_1", "chunk_2"]
+    assert matches[1]["metadata"] == {"source": "b.py"}
+    print("✅ test_hybrid_search_sends_sparse_terms_and_parses_results passed!")
+
+
+def test_collection_handles_are_shared_and_verified_once():
+    info = MagicMock(status_code=200, json=lambda: {"dimension": 8, "space_type": "cosine"})
+    with patch("endee_client.requests.Session.get", return_value=info) as get:
+        first = get_collection("shared", base_url="http://endee:8080/")
+        second = get_collection("shared", base_url="http://endee:8080")
+    endee_client.drop_collection_handle("shared", base_url="http://endee:8080")
+
+    assert first is second
+    assert get.call_count == 1
+    assert (first.dim, first.space_type, first.local_mode) == (8, "cosine", False)
+    print("✅ test_collection_handles_are_shared_and_verified_once passed!")
+
+
+def test_local_fallback_handle_is_rebuilt_after_retry_interval():
+    with patch("endee_client.requests.Session.get", side_effect=endee_client.requests.exceptions.ConnectionError):
+        down = get_collection("flaky", base_url="http://endee:8080", local_path="/tmp/flaky")
+    assert down.local_mode
+
+    info = MagicMock(status_code=200, json=lambda: {"dimension": 4, "space_type": "l2"})
+    with patch("endee_client.requests.Session.get", return_value=info) as get:
+        # Within the retry interval the fallback handle is kept without probing
+        assert get_collection("flaky", base_url="http://endee:8080") is down
+        assert get.call_count == 0
+        with patch.object(endee_client.time, "monotonic", return_value=down.local_since + endee_client.LOCAL_MODE_RETRY_SECONDS):
+            back = get_collection("flaky", base_url="http://endee:8080")
+    endee_client.drop_collection_handle("flaky", base_url="http://endee:8080")
+
+    assert back is not down and not back.local_mode
+    assert back.local_path == "/tmp/flaky"
+    print("✅ test_local_fallback_handle_is_rebuilt_after_retry_interval passed!")
+
+
+def test_local_fallback_handle_with_writes_stays_local(tmp_path):
+    with patch("endee_client.requests.Session.get", side_effect=endee_client.requests.exceptions.ConnectionError):
+        down = get_collection("written", base_url="http://endee:8080", local_path=str(tmp_path))
+    assert down.local_mode and not down.local_writes
+    down.insert_many([0], np.random.rand(1, 4).astype(np.float32), [{"source": "a.py"}])
+    assert down.local_writes
+
+    info = MagicMock(status_code=200, json=lambda: {"dimension": 4, "space_type": "l2"})
+    with patch("endee_client.requests.Session.get", return_value=info) as get:
+        # The vector only exists locally, so the server must not take over the handle
+        with patch.object(endee_client.time, "monotonic", return_value=down.local_since + endee_client.LOCAL_MODE_RETRY_SECONDS):
+            assert get_collection("written", base_url="http://endee:8080") is down
+        assert get.call_count == 0
+    endee_client.drop_collection_handle("written", base_url="http://endee:8080")
+    print("✅ test_local_fallback_handle_with_writes_stays_local passed!")
+
+
+def test_failed_server_deletes_raise():
+    db = make_db()
+    failed = MagicMock(status_code=500, text="boom")
+    with patch.object(db.session, "delete", return_value=failed):
+        for call in (lambda: db.delete_by_source(["a.py"]), db.reset):
+            try:
+                call()
+                assert False, "a failed delete must not be swallowed"
+            except RuntimeError as e:
+                assert "500" in str(e)
+    with patch.object(db.session, "delete", side_effect=endee_client.requests.exceptions.Timeout):
+        try:
+            db.delete_by_source(["a.py"])
+            assert False, "a timed out delete must not be swallowed"
+        except RuntimeError:
+            pass
+
+    with patch.object(db.session, "delete", return_value=MagicMock(status_code=200, text="3 vectors deleted")):
+        assert db.delete_by_source(["a.py"]) == 3
+    print("✅ test_failed_server_deletes_raise passed!")
+
+
+def test_reset_recreates_index_with_requested_sparse_dim():
+    old_schema = MagicMock(status_code=200, json=lambda: {"dimension": 384, "space_type": "l2", "sparse_dim": 0})
+    with patch("endee_client.requests.Session.get", return_value=old_schema):
+        db = EndeeDB(collection_name="test", sparse_dim=1024)
+    assert db.sparse_dim == 0  # the existing index has no sparse vectors
+
+    missing = MagicMock(status_code=404)
+    new_schema = MagicMock(status_code=200, json=lambda: {"dimension": 384, "space_type": "l2", "sparse_dim": 1024})
+    with patch.object(db.session, "delete", return_value=MagicMock(status_code=200)), \
+            patch.object(db.session, "get", side_effect=[missing, new_schema]), \
+            patch.object(db.session, "post", return_value=MagicMock(status_code=200)) as post:
+        db.reset()
+
+    assert post.call_args.kwargs["json"] == {"index_name": "test", "dim": 384, "space_type": "l2", "sparse_dim": 1024}
+    assert db.sparse_dim == 1024
+    print("✅ test_reset_recreates_index_with_requested_sparse_dim passed!")
+
+
+def test_local_store_matches_bruteforce_cosine():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((300, 16)).astype(np.float32)
+    store = LocalVectorStore(initial_capacity=8)
+    for start in range(0, 300, 7):
+        store.add(range(start, min(start + 7, 300)), vectors[start:start + 7])
+
+    queries = rng.standard_normal((3, 16)).astype(np.float32)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    for query, matches in zip(queries, store.search_many(queries, top_k=5)):
+        expected = np.argsort(-(normalized @ query))[:5]
+        assert [m["id"] for m in matches] == [str(i) for i in expected]
+    print("✅ test_local_store_matches_bruteforce_cosine passed!")
+
+
+def test_local_store_persists_and_reopens(tmp_path):
+    vectors = np.random.rand(10, 8).astype(np.float32)
+    store = LocalVectorStore(path=str(tmp_path), initial_capacity=4)
+    store.add(range(10), vectors, [{"source": f"file_{i}.py"} for i in range(10)])
+    store.update_metadata(3, {"source": "renamed.py"})
+    expected = store.search(vectors[3], top_k=3)
+
+    reopened = LocalVectorStore(path=str(tmp_path))
+    assert isinstance(reopened._matrix, np.memmap)
+    assert len(reopened) == 10
+    assert reopened.search(vectors[3], top_k=3) == expected
+    assert expected[0]["metadata"] == {"source": "renamed.py"}
+    print("✅ test_local_store_persists_and_reopens passed!")
+
+
+def test_local_store_delete_survives_reopen(tmp_path):
+    vectors = np.random.rand(6, 8).astype(np.float32)
+    store = LocalVectorStore(path=str(tmp_path))
+    store.add(range(6), vectors, [{"source": "a.py" if i < 3 else "b.py"} for i in range(6)])
+    assert store.delete(["0", "1", "2", "missing"]) == 3
+
+    reopened = LocalVectorStore(path=str(tmp_path))
+    assert len(reopened) == 3
+    matches = reopened.search(vectors[0], top_k=6)
+    assert {m["id"] for m in matches} == {"3", "4", "5"}
+    print("✅ test_local_store_delete_survives_reopen passed!")
+
+
+if __name__ == "__main__":
+    test_insert_many_packs_one_request_per_batch()
+    test_hybrid_search_sends_sparse_terms_and_parses_results()
+    test_collection_handles_are_shared_and_verified_once()
+    test_local_fallback_handle_is_rebuilt_after_retry_interval()
+    test_local_fallback_handle_with_writes_stays_local(tempfile.mkdtemp())
+    test_failed_server_deletes_raise()
+    test_reset_recreates_index_with_requested_sparse_dim()
+    test_local_store_matches_bruteforce_cosine()
+    import tempfile
+    test_local_store_persists_and_reopens(tempfile.mkdtemp())
+    test_local_store_delete_survives_reopen(tempfile.mkdtemp())
@@ -0,0 +1,516 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import numpy as np
+
+# These tests drive real clones and fetches, so they need the real GitPython even
+# when another test module has replaced it with a mock
+_mocked_git = sys.modules.pop('git', None)
+import git as real_git
+if _mocked_git is not None:
+    sys.modules['git'] = _mocked_git
+
+import backend
+from backend import CodeRAG, DEDUPE_FILE, MIRROR_STAMP, _mirror_in_use, evict_mirrors, load_corpus
+from endee_client import drop_collection_handle
+
+GIT_ENV = {"GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@example.com",
+           "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@example.com"}
+
+
+def run_git(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True,
+                          env={**os.environ, **GIT_ENV}).stdout.strip()
+
+
+def make_origin(root, files):
+    """Creates a source repository with one commit holding `files` (path -> content)."""
+    origin = os.path.join(root, "origin")
+    os.makedirs(origin)
+    run_git(origin, "init", "-q", "-b", "main")
+    commit_files(origin, files, "initial")
+    return origin
+
+
+def commit_files(origin, files, message, removed=(), renamed=()):
+    for rel_path, content in files.items():
+        path = os.path.join(origin, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+    for rel_path in removed:
+        run_git(origin, "rm", "-q", rel_path)
+    for old, new in renamed:
+        os.makedirs(os.path.dirname(os.path.join(origin, new)), exist_ok=True)
+        run_git(origin, "mv", old, new)
+    run_git(origin, "add", "-A")
+    run_git(origin, "commit", "-q", "-m", message)
+    return run_git(origin, "rev-parse", "HEAD")
+
+
+def fake_encode(self, texts, batch_size):
+    """Deterministic stand-in for the embedding model."""
+    rows = [np.frombuffer(hashlib.sha256(t.encode("utf-8")).digest(), dtype=np.uint8) for t in texts]
+    return np.asarray(rows, dtype=np.float32).reshape(len(texts), 32) + 1.0
+
+
+def make_rag(root, origin, **kwargs):
+    """A CodeRAG working entirely under `root`, in Endee local mode."""
+    kwargs.setdefault("use_mirror", False)
+    rag = CodeRAG(f"file://{origin}", use_embedding_cache=False, ingest_workers=1, **kwargs)
+    rag.repo_name = os.path.basename(root)  # a fresh collection per test
+    rag.base_dir = root
+    rag.repo_path = os.path.join(root, "repo_data", rag.repo_name)
+    rag.vector_store_path = os.path.join(root, "vector_store", rag.repo_name)
+    rag._collection().local_mode = True
+    rag._collection().local_since = float("inf")  # never re-probe during the test
+    return rag
+
+
+def indexed_sources(rag):
+    """Relative paths of the files in the saved corpus and in the local vector store."""
+    rel = lambda source: os.path.relpath(source, rag.repo_path).replace(os.sep, "/")
+    chunks, _, _ = load_corpus(rag.vector_store_path)
+    store = rag._collection().local_store
+    stored = {rel(store.metadata[row]["source"]) for row in range(store.count) if row not in store._deleted}
+    return {rel(c.metadata["source"]) for c in chunks}, stored, chunks
+
+
+def with_git(test):
+    def wrapper():
+        root = tempfile.mkdtemp()
+        try:
+            with patch.object(backend, "git", real_git), patch.object(CodeRAG, "_encode", fake_encode):
+                test(root)
+        finally:
+            drop_collection_handle(os.path.basename(root))
+            shutil.rmtree(root, ignore_errors=True)
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+
+@with_git
+def test_update_index_follows_changed_removed_and_renamed_files(root):
+    origin = make_origin(root, {
+        "keep.py": "def keep():\n    return 'unchanged'\n",
+        "change.py": "def before():\n    return 1\n",
+        "remove.py": "def removed():\n    return 2\n",
+        "old/name.py": "def moved():\n    return 3\n",
+        "notes.txt": "not indexed\n",
+    })
+    rag = make_rag(root, origin)
+    rag.clone_repo()
+    assert "from scratch" in rag.update_index()
+    corpus, stored, _ = indexed_sources(rag)
+    assert corpus == stored == {"keep.py", "change.py", "remove.py", "old/name.py"}
+
+    head = commit_files(origin, {"change.py": "def after():\n    return 10\n"}, "edit",
+                        removed=["remove.py"], renamed=[("old/name.py", "new/name.py")])
+    message = rag.update_index()
+    # Renames arrive as a delete plus an add (--no-renames)
+    assert message.startswith("Re-indexed 2 changed and 2 removed files"), message
+    corpus, stored, chunks = indexed_sources(rag)
+    assert corpus == stored == {"keep.py", "change.py", "new/name.py"}
+    text = {os.path.basename(c.metadata["source"]): c.page_content for c in chunks}
+    assert "after" in text["change.py"] and "before" not in text["change.py"]
+    assert rag._read_index_state()["commit"] == head
+    # Chunk ids keep counting up, so ids of deleted chunks are never reused
+    ids = [int(c.metadata["chunk_id"].split("_")[1]) for c in chunks]
+    assert len(set(ids)) == len(ids) and max(ids) >= 4
+
+    assert "already indexed" in rag.update_index()
+    print("✅ test_update_index_follows_changed_removed_and_renamed_files passed!")
+
+
+@with_git
+def test_update_index_keeps_state_when_delete_fails(root):
+    origin = make_origin(root, {"a.py": "def a():\n    return 1\n"})
+    rag = make_rag(root, origin)
+    rag.clone_repo()
+    rag.update_index()
+    indexed = rag._read_index_state()["commit"]
+    commit_files(origin, {"a.py": "def a():\n    return 2\n"}, "edit")
+
+    db = rag._collection()
+    with patch.object(db, "delete_by_source", side_effect=RuntimeError("Delete failed: 500")):
+        try:
+            rag.update_index()
+            assert False, "a failed delete must not be ignored"
+        except RuntimeError:
+            pass
+    # Nothing new was inserted and the next update retries the same diff
+    assert rag._read_index_state()["commit"] == indexed
+    _, stored, _ = indexed_sources(rag)
+    assert len(db.local_store) == 1 and stored == {"a.py"}
+    assert "1 changed" in rag.update_index()
+    _, _, chunks = indexed_sources(rag)
+    assert "return 2" in chunks[0].page_content and len(db.local_store) == 1
+    print("✅ test_update_index_keeps_state_when_delete_fails passed!")
+
+
+@with_git
+def test_failed_reingest_forces_full_ingest_next_time(root):
+    origin = make_origin(root, {f"m{i}.py": f"def f{i}():\n    return {i}\n" for i in range(40)})
+    rag = make_rag(root, origin, embed_batch_size=16)
+    rag.clone_repo()
+    rag.update_index()
+    assert os.path.exists(os.path.join(rag.vector_store_path, DEDUPE_FILE))
+
+    # The collection is wiped before the re-ingest fails, so the old state must go too
+    with patch.object(CodeRAG, "_encode", side_effect=RuntimeError("embedding model crashed")):
+        try:
+            rag.ingest()
+            assert False, "the embed error must reach ingest()"
+        except RuntimeError:
+            pass
+    assert rag._read_index_state() == {}
+    assert not os.path.exists(os.path.join(rag.vector_store_path, DEDUPE_FILE))
+
+    assert "from scratch" in rag.update_index()
+    corpus, stored, _ = indexed_sources(rag)
+    assert len(corpus) == len(stored) == 40
+    print("✅ test_failed_reingest_forces_full_ingest_next_time passed!")
+
+
+@with_git
+def test_index_follows_the_store_holding_the_vectors(root):
+    origin = make_origin(root, {f"m{i}.py": f"def f{i}():\n    return {i}\n" for i in range(12)})
+    rag = make_rag(root, origin, embed_batch_size=4)
+    rag.clone_repo()
+    db = rag._collection()
+
+    # The server fails after the first batch: the rest lands locally, so the whole
+    # repo is re-ingested into the local store instead of being split across both
+    db.local_mode = False
+    insert_many = db.insert_many
+    def failing_server(*args, **kwargs):
+        db.local_mode, db.local_since = True, float("inf")
+        return insert_many(*args, **kwargs)
+    with patch.object(db, "reset", side_effect=db.local_store.clear), \
+         patch.object(db, "insert_many", side_effect=failing_server):
+        rag.ingest()
+    assert rag._read_index_state()["local"] is True
+    corpus, stored, _ = indexed_sources(rag)
+    assert len(corpus) == len(stored) == 12
+
+    # An index built on the server is not diffed against the local store (or back)
+    state = rag._read_index_state()
+    rag._write_index_state(**dict(state, local=False))
+    assert rag.update_index() == f"Re-indexed {rag.repo_name} into the local store."
+    assert rag._read_index_state()["local"] is True
+    corpus, stored, _ = indexed_sources(rag)
+    assert len(corpus) == len(stored) == 12
+    assert "already indexed" in rag.update_index()
+    print("✅ test_index_follows_the_store_holding_the_vectors passed!")
+
+
+@with_git
+def test_legacy_load_and_create_keep_duplicate_aliases(root):
+    body = "def shared(value):\n    return value * 2 + 1\n"
+    origin = make_origin(root, {"m0.py": body, "m1.py": body, "m2.py": body, "other.py": "def other():\n    return 0\n"})
+    rag = make_rag(root, origin)
+    rag.clone_repo()
+    chunks = rag.load_and_process_files()
+    # Identical files are embedded once
+    assert sorted(os.path.basename(c.metadata["source"]) for c in chunks) == ["m0.py", "other.py"]
+    rag.create_vector_store(chunks)
+    assert rag._read_index_state()["commit"]
+    aliases = lambda: {os.path.basename(source) for sources in rag._chunk_aliases().values() for source in sources}
+    assert aliases() == {"m1.py", "m2.py"}
+
+    # Editing the indexed copy brings its duplicates back
+    commit_files(origin, {"m0.py": "def changed():\n    return 3\n"}, "edit m0")
+    # m1.py is embedded again and m2.py becomes its alias
+    assert rag.update_index().startswith("Re-indexed 3 changed and 0 removed files (2 new chunks)")
+    corpus, stored, _ = indexed_sources(rag)
+    assert corpus == stored == {"m0.py", "m1.py", "other.py"}
+    assert aliases() == {"m2.py"}
+    print("✅ test_legacy_load_and_create_keep_duplicate_aliases passed!")
+
+
+@with_git
+def test_clones_keep_every_file_for_the_ui(root):
+    origin = make_origin(root, {
+        "src/app.py": "def main():\n    return 0\n",
+        "LICENSE": "MIT License\n",
+        "Dockerfile": "FROM python:3.11\n",
+        "config/settings.yaml": "debug: false\n",
+        "assets/big.bin": "x" * (2 * 1024 * 1024),
+    })
+    expected = {"src/app.py", "LICENSE", "Dockerfile", "config/settings.yaml", "assets/big.bin"}
+    for use_mirror in (False, True):
+        rag = make_rag(root, origin, use_mirror=use_mirror)
+        rag.repo_path += "-mirror" if use_mirror else "-clone"
+        assert ("local mirror" in rag.clone_repo()) == use_mirror
+        files = {f["path"].replace(os.sep, "/") for f in rag.get_repo_structure() if f["type"] == "file"}
+        assert files == expected, files
+        assert os.path.getsize(os.path.join(rag.repo_path, "assets", "big.bin")) == 2 * 1024 * 1024
+        # Only the code is indexed
+        rel = {os.path.relpath(p, rag.repo_path).replace(os.sep, "/") for p in rag._iter_source_files()}
+        assert rel == {"src/app.py"}
+    print("✅ test_clones_keep_every_file_for_the_ui passed!")
+
+
+@with_git
+def test_mirror_is_created_reused_and_fetched_incrementally(root):
+    origin = make_origin(root, {"a.py": "def a():\n    return 1\n"})
+    first = make_rag(root, origin, use_mirror=True)
+    assert "local mirror" in first.clone_repo()
+    mirror = first._mirror_path()
+    assert run_git(mirror, "rev-parse", "--is-bare-repository") == "true"
+    assert run_git(first.repo_path, "rev-parse", "HEAD") == run_git(origin, "rev-parse", "HEAD")
+    # The checkout is a worktree of the mirror, sharing its objects
+    assert _mirror_in_use(mirror)
+    assert os.path.isfile(os.path.join(first.repo_path, ".git"))
+
+    # A second session reuses the mirror and only fetches the new commit
+    run_git(mirror, "config", "coderag.test", "kept")
+    head = commit_files(origin, {"b.py": "def b():\n    return 2\n"}, "second")
+    second = make_rag(root, origin, use_mirror=True)
+    second.repo_path += "-second"
+    assert "local mirror" in second.clone_repo()
+    assert second._mirror_path() == mirror and run_git(mirror, "config", "coderag.test") == "kept"
+    assert run_git(second.repo_path, "rev-parse", "HEAD") == head
+    assert os.path.exists(os.path.join(second.repo_path, "b.py"))
+    # Private fetch refs are deleted once resolved
+    assert run_git(mirror, "for-each-ref", "refs/coderag") == ""
+
+    # Deleting a checkout releases the mirror
+    shutil.rmtree(first.repo_path)
+    shutil.rmtree(second.repo_path)
+    assert not _mirror_in_use(mirror)
+    print("✅ test_mirror_is_created_reused_and_fetched_incrementally passed!")
+
+
+@with_git
+def test_worktree_update_waits_for_the_mirror_lock(root):
+    origin = make_origin(root, {"a.py": "def a():\n    return 1\n"})
+    rag = make_rag(root, origin, use_mirror=True)
+    rag.clone_repo()
+    rag.update_index()
+    commit_files(origin, {"b.py": "def b():\n    return 2\n"}, "second")
+
+    # Another session holds the mirror (e.g. mid-fetch): the worktree's fetch waits for it
+    results = []
+    with backend._file_lock(f"{rag._mirror_path()}.lock"):
+        updater = threading.Thread(target=lambda: results.append(rag.update_index()))
+        updater.start()
+        updater.join(0.5)
+        assert updater.is_alive() and not results
+    updater.join()
+    assert results[0].startswith("Re-indexed 1 changed"), results
+    print("✅ test_worktree_update_waits_for_the_mirror_lock passed!")
+
+
+@with_git
+def test_concurrent_mirror_checkouts_get_their_own_ref(root):
+    origin = make_origin(root, {"a.py": "def a():\n    return 1\n"})
+    main = run_git(origin, "rev-parse", "HEAD")
+    run_git(origin, "checkout", "-q", "-b", "feature")
+    feature = commit_files(origin, {"f.py": "def f():\n    return 3\n"}, "feature")
+    run_git(origin, "checkout", "-q", "main")
+    run_git(origin, "tag", "-a", "v1", "-m", "release", main)
+
+    sessions = {None: main, "feature": feature, "v1": main}
+    rags = []
+    for n in range(6):
+        ref = list(sessions)[n % 3]
+        rag = make_rag(root, origin, use_mirror=True, ref=ref)
+        rag.repo_path += f"-{n}"
+        rags.append(rag)
+    errors = []
+
+    def checkout(rag):
+        try:
+            os.makedirs(rag.repo_path)
+            rag._checkout_from_mirror()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=checkout, args=(rag,)) for rag in rags]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Shallow fetches of different refs into the shared mirror neither fail nor mix up results
+    assert not errors, errors
+    for rag in rags:
+        assert run_git(rag.repo_path, "rev-parse", "HEAD") == sessions[rag.ref], rag.ref
+    assert len(run_git(rags[0]._mirror_path(), "worktree", "list").splitlines()) == 1 + len(rags)
+    print("✅ test_concurrent_mirror_checkouts_get_their_own_ref passed!")
+
+
+def make_fake_mirror(root, name, size, age_days):
+    path = os.path.join(root, f"{name}.git")
+    os.makedirs(path)
+    with open(os.path.join(path, "pack"), "wb") as f:
+        f.write(b"\0" * size)
+    stamp = os.path.join(path, MIRROR_STAMP)
+    open(stamp, "w").close()
+    used = time.time() - age_days * 86400
+    os.utime(stamp, (used, used))
+    return path
+
+
+def test_evict_mirrors_applies_age_and_size_limits():
+    root = tempfile.mkdtemp()
+    try:
+        stale = make_fake_mirror(root, "stale", 100, age_days=40)
+        old = make_fake_mirror(root, "old", 400, age_days=5)
+        recent = make_fake_mirror(root, "recent", 400, age_days=1)
+        fresh = make_fake_mirror(root, "fresh", 400, age_days=0)
+        os.makedirs(os.path.join(root, "not-a-mirror"))
+
+        # Only the mirror unused for longer than max_age_days goes
+        assert evict_mirrors(root, max_age_days=30, max_bytes=10_000) == [stale]
+        # Then the least recently used until the store fits
+        assert evict_mirrors(root, max_age_days=30, max_bytes=900) == [old]
+        assert evict_mirrors(root, max_age_days=30, max_bytes=900) == []
+
+        # A mirror with a live worktree is kept even when it is the oldest
+        checkout = os.path.join(root, "checkout")
+        os.makedirs(checkout)
+        os.makedirs(os.path.join(recent, "worktrees", "checkout"))
+        with open(os.path.join(recent, "worktrees", "checkout", "gitdir"), "w") as f:
+            f.write(os.path.join(checkout, ".git") + "\n")
+        open(os.path.join(checkout, ".git"), "w").close()
+        assert _mirror_in_use(recent) and not _mirror_in_use(fresh)
+        assert evict_mirrors(root, max_age_days=30, max_bytes=0) == [fresh]
+        assert sorted(os.listdir(root)) == ["checkout", "not-a-mirror", "recent.git"]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print("✅ test_evict_mirrors_applies_age_and_size_limits passed!")
+
+
+@with_git
+def test_update_index_streams_large_files(root):
+    big = "".join(f"def row_{i}(db):\n    return db.insert({{'id': {i}, 'name': 'row {i}'}})\n\n" for i in range(6000))
+    origin = make_origin(root, {"a.py": "def a():\n    return 1\n"})
+    rag = make_rag(root, origin)
+    rag.clone_repo()
+    rag.update_index()
+
+    # latin.py only stops decoding as UTF-8 near its end, past any content sniffing
+    with open(os.path.join(origin, "latin.py"), "wb") as f:
+        f.write((big + "# caf\u00e9\n").encode("latin-1"))
+    commit_files(origin, {"big.py": big}, "large files")
+    assert len(big) > backend.STREAM_SPLIT_BYTES
+
+    # Large files never go through _split_file (whole-file reads, pickled lists)
+    split_file = backend._split_file
+    with patch.object(backend, "_split_file", side_effect=split_file) as small:
+        message = rag.update_index()
+    assert all(not backend._is_large_file(call.args[0]) for call in small.call_args_list)
+
+    assert message.startswith("Re-indexed 2 changed"), message
+    assert not rag.skip_report
+    corpus, stored, chunks = indexed_sources(rag)
+    assert corpus == stored == {"a.py", "big.py"}
+    big_chunks = [c for c in chunks if c.metadata["source"].endswith("big.py")]
+    assert all(big[c.metadata["start"]:c.metadata["start"] + len(c.page_content)] == c.page_content for c in big_chunks)
+    assert " ".join(c.page_content for c in big_chunks).split() == big.split()
+    print("✅ test_update_index_streams_large_files passed!")
+
+
+def write_files(root, count):
+    """A plain directory of small, distinct Python files (one chunk each)."""
+    repo = os.path.join(root, "files")
+    for i in range(count):
+        path = os.path.join(repo, f"pkg{i % 7}", f"mod_{i:04d}.py")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"def function_{i}(value):\n    return value * {i} + {i * i}\n")
+    return repo
+
+
+def make_dir_rag(root, repo, **kwargs):
+    rag = make_rag(root, repo, **kwargs)
+    rag.repo_path = repo
+    return rag
+
+
+@with_git
+def test_pipeline_keeps_walk_order_and_backpressure(root):
+    rag = make_dir_rag(root, write_files(root, 600), embed_batch_size=16)
+    rag.ingest_workers = 2
+    walked, embedded, lead = [0], [0], []
+    iter_files = CodeRAG._iter_source_files
+
+    def counting_walk(self):
+        for file_path in iter_files(self):
+            walked[0] += 1
+            yield file_path
+
+    def slow_encode(self, texts, batch_size):
+        lead.append(walked[0] - embedded[0])
+        time.sleep(0.002)
+        embedded[0] += len(texts)
+        return fake_encode(self, texts, batch_size)
+
+    with patch.object(backend, "PIPELINE_FILE_QUEUE", 4), patch.object(backend, "PIPELINE_CHUNK_QUEUE", 4), \
+            patch.object(backend, "PIPELINE_VECTOR_QUEUE", 2), \
+            patch.object(CodeRAG, "_iter_source_files", counting_walk), patch.object(CodeRAG, "_encode", slow_encode):
+        stats = rag.ingest()
+
+    # The walk waits for embedding: the first 256 chunks size the batches, then the
+    # bounded queues and worker window hold the walk a few batches ahead at most
+    assert stats["chunks"] == embedded[0] == 600
+    assert lead[0] < 600 and max(lead) <= 256 + 16 * 4 + 2 * 4 * 2, max(lead)
+
+    # Chunks keep walk order across worker processes, numbered consecutively
+    chunks, _, _ = load_corpus(rag.vector_store_path)
+    assert [c.metadata["source"] for c in chunks] == list(iter_files(rag))
+    assert [c.metadata["chunk_id"] for c in chunks] == [f"chunk_{i}" for i in range(600)]
+    assert len(rag._collection().local_store) == 600
+    print("✅ test_pipeline_keeps_walk_order_and_backpressure passed!")
+
+
+@with_git
+def test_pipeline_embed_failure_reaches_ingest(root):
+    rag = make_dir_rag(root, write_files(root, 400), embed_batch_size=16)
+    rag.ingest_workers = 2
+    calls = [0]
+
+    def failing_encode(self, texts, batch_size):
+        calls[0] += 1
+        if calls[0] == 3:
+            raise RuntimeError("embedding model crashed")
+        return fake_encode(self, texts, batch_size)
+
+    started = time.time()
+    with patch.object(CodeRAG, "_encode", failing_encode):
+        try:
+            rag.ingest()
+            assert False, "the embed error must reach ingest()"
+        except RuntimeError as e:
+            assert "embedding model crashed" in str(e)
+    # Every stage stopped instead of blocking on a full queue
+    assert time.time() - started < 30
+    assert calls[0] == 3
+    # No half-written corpus or index state is left behind
+    assert load_corpus(rag.vector_store_path) is None
+    assert rag._read_index_state() == {}
+    print("✅ test_pipeline_embed_failure_reaches_ingest passed!")
+
+
+if __name__ == "__main__":
+    test_update_index_follows_changed_removed_and_renamed_files()
+    test_update_index_keeps_state_when_delete_fails()
+    test_failed_reingest_forces_full_ingest_next_time()
+    test_update_index_streams_large_files()
+    test_index_follows_the_store_holding_the_vectors()
+    test_legacy_load_and_create_keep_duplicate_aliases()
+    test_clones_keep_every_file_for_the_ui()
+    test_mirror_is_created_reused_and_fetched_incrementally()
+    test_worktree_update_waits_for_the_mirror_lock()
+    test_concurrent_mirror_checkouts_get_their_own_ref()
+    test_evict_mirrors_applies_age_and_size_limits()
+    test_pipeline_keeps_walk_order_and_backpressure()
+    test_pipeline_embed_failure_reaches_ingest()
@@ -1,6 +1,10 @@
+import json
 import os
+import subprocess
 import sys
-from unittest.mock import MagicMock
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
 
 # Mocking modules that might not be fully installed or needed for basic logic test
 sys.modules['langchain_community.embeddings'] = MagicMock()
@@ -9,7 +13,10 @@ sys.modules['langchain_community.llms'] = MagicMock()
 sys.modules['sentence_transformers'] = MagicMock()
 sys.modules['git'] = MagicMock()
 
-from backend import CodeRAG
+import numpy as np
+
+from profile_imports import HEAVY_PACKAGES, import_times
+from backend import _chunk_text, _split_file_windows, BM25Index, CodeRAG, ContextPacker, Deduplicator, Document, EmbeddingCache, FileSelector, Reranker, get_answer_cache, get_ollama_client
 
 def test_clean_code():
     rag = CodeRAG("https://github.com/test/repo")
@@ -32,21 +39,373 @@ def test_clean_code():
 
 def test_caching():
     rag = CodeRAG("https://github.com/test/repo")
-    # Mocking retrieval and LLM call
+    rag.vector_store_path = tempfile.mkdtemp()
+    # Mocking retrieval; the LLM must not be called on a cache hit
     rag.load_vector_store = MagicMock()
-    mock_llm = MagicMock()
-    mock_llm.invoke.return_value = "Mocked result"
-    
-    # We need to mock Ollama constructor or the LLM call inside ask_question
-    # This is a bit complex for a simple script, so let's check the cache dict directly
+    rag._embed_texts = MagicMock(return_value=np.ones((1, 4), dtype=np.float32))
+    doc = Document(page_content="def hello(): pass", metadata={"source": "a.py", "chunk_id": "chunk_0"})
+    rag._vector_search = MagicMock(return_value=[(doc, 1.0)])
+
     query = "test question"
-    response = {"result": "Cached result", "source_documents": []}
-    rag.cache[query] = response
-    
-    result = rag.ask_question(query)
-    assert result == response
+    cache = get_answer_cache(rag.vector_store_path)
+    scope, key = cache.key(None, rag.model_name, ["chunk_0"], query)
+    cache.put(scope, key, "Cached result", np.ones(4))
+
+    with patch("backend.get_ollama_client") as ollama:
+        assert "".join(rag.ask_question("Test question?")) == "Cached result"
+        # A near-duplicate question over the same chunks reuses the answer too
+        assert "".join(rag.ask_question("test questions")) == "Cached result"
+        ollama.assert_not_called()
+    assert rag.last_response["metrics"]["cached"]
+
+    # Re-indexing invalidates cached answers
+    rag._write_index_state(commit="abc")
+    assert len(get_answer_cache(rag.vector_store_path)) == 0
     print("✅ test_caching passed!")
 
+def test_retrieval_overlaps_vector_and_keyword_search():
+    rag = CodeRAG("https://github.com/test/repo")
+    rag.vector_store_path = tempfile.mkdtemp()
+    db = MagicMock(local_mode=True)
+    vector_doc = Document(page_content="def a(): pass", metadata={"chunk_id": "chunk_0"})
+    keyword_doc = Document(page_content="def b(): pass", metadata={"chunk_id": "chunk_1"})
+    rag._embed_texts = MagicMock(return_value=np.ones((1, 4), dtype=np.float32))
+    rag._vector_search = MagicMock(side_effect=lambda *args: time.sleep(0.3) or [(vector_doc, 1 / 61)])
+    rag._keyword_search = MagicMock(side_effect=lambda *args: time.sleep(0.3) or [keyword_doc])
+
+    started = time.time()
+    query_vector, scored_docs = rag.retrieve(db, "what does b do")
+    assert time.time() - started < 0.5
+    assert query_vector == [1.0] * 4
+    assert [doc for doc, _ in scored_docs] == [vector_doc, keyword_doc]
+    print("✅ test_retrieval_overlaps_vector_and_keyword_search passed!")
+
+def test_chat_session_carries_ollama_context():
+    rag = CodeRAG("https://github.com/test/repo", semantic_answer_cache=False)
+    rag.vector_store_path = tempfile.mkdtemp()
+    rag.load_vector_store = MagicMock()
+    rag._embed_texts = MagicMock(return_value=np.ones((1, 4), dtype=np.float32))
+    doc = Document(page_content="def hello(): pass", metadata={"source": "a.py", "chunk_id": "chunk_0"})
+    rag._vector_search = MagicMock(return_value=[(doc, 1.0)])
+
+    def reply(context):
+        response = MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_lines.return_value = [b'{"response": "Hi", "done": false}',
+                                            json.dumps({"done": True, "context": context}).encode()]
+        return response
+
+    client = get_ollama_client()
+    with patch.object(client.session, "post", side_effect=[reply([1, 2]), reply([1, 2, 3, 4]), reply([9])]) as post:
+        assert "".join(rag.ask_question("what is hello")) == "Hi"
+        assert "".join(rag.ask_question("and who calls it")) == "Hi"
+        # One-off prompts start from scratch and leave the chat session alone
+        "".join(rag.ask_question("explain a.py", chat_session=False))
+    payloads = [call.kwargs["json"] for call in post.call_args_list]
+    assert "context" not in payloads[0] and payloads[1]["context"] == [1, 2]
+    assert "context" not in payloads[2] and rag.chat_session["context"] == [1, 2, 3, 4]
+    print("✅ test_chat_session_carries_ollama_context passed!")
+
+def test_answer_cache_skips_follow_ups():
+    rag = CodeRAG("https://github.com/test/repo", semantic_answer_cache=False)
+    rag.vector_store_path = tempfile.mkdtemp()
+    rag.load_vector_store = MagicMock()
+    rag._embed_texts = MagicMock(return_value=np.ones((1, 4), dtype=np.float32))
+    doc = Document(page_content="def hello(): pass", metadata={"source": "a.py", "chunk_id": "chunk_0"})
+    rag._vector_search = MagicMock(return_value=[(doc, 1.0)])
+
+    def reply(text, context):
+        response = MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_lines.return_value = [json.dumps({"response": text, "done": False}).encode(),
+                                            json.dumps({"done": True, "context": context}).encode()]
+        return response
+
+    client = get_ollama_client()
+    replies = [reply("hello prints", [1, 2]), reply("main calls it", [1, 2, 3]), reply("which function?", [7])]
+    with patch.object(client.session, "post", side_effect=replies) as post:
+        assert "".join(rag.ask_question("what is hello")) == "hello prints"
+        assert "".join(rag.ask_question("and who calls it")) == "main calls it"
+        # Another conversation asking the same follow-up must not get the first one's answer
+        rag.reset_chat_session()
+        assert "".join(rag.ask_question("and who calls it")) == "which function?"
+        # A fresh question is still served from the cache, and the turn is recorded
+        rag.reset_chat_session()
+        assert "".join(rag.ask_question("what is hello")) == "hello prints"
+    assert post.call_count == 3 and rag.last_response["metrics"]["cached"]
+    assert rag.chat_session == {"model": rag.model_name, "context": None, "turns": 1}
+    print("✅ test_answer_cache_skips_follow_ups passed!")
+
+def test_bm25_index_matches_full_scoring():
+    rng = np.random.default_rng(0)
+    docs = [(rng.zipf(1.5, size=rng.integers(1, 40)) % 50).tolist() for _ in range(300)]
+    tokens = np.array([t for d in docs for t in d], dtype=np.int32)
+    offsets = np.concatenate(([0], np.cumsum([len(d) for d in docs]))).astype(np.int64)
+    index = BM25Index(tokens, offsets)
+
+    for _ in range(50):
+        query = rng.integers(-1, 50, size=rng.integers(1, 5)).tolist()
+        scores = index.get_scores(query)
+        expected = np.argsort(scores, kind="stable")[::-1][:5]
+        assert np.allclose(scores[index.top_n(query, n=5)], scores[expected])
+    print("✅ test_bm25_index_matches_full_scoring passed!")
+
+def test_bm25_index_top_n_matches_bm25okapi():
+    from rank_bm25 import BM25Okapi
+    rng = np.random.default_rng(1)
+    docs = [(rng.zipf(1.3, size=rng.integers(1, 60)) % 80).tolist() for _ in range(400)]
+    # Token ids are dense in a saved corpus: every id occurs somewhere
+    vocab = {t: i for i, t in enumerate(sorted({t for d in docs for t in d}))}
+    docs = [[vocab[t] for t in d] for d in docs]
+    tokens = np.array([t for d in docs for t in d], dtype=np.int32)
+    offsets = np.concatenate(([0], np.cumsum([len(d) for d in docs]))).astype(np.int64)
+    index = BM25Index(tokens, offsets)
+    reference = BM25Okapi([[str(t) for t in d] for d in docs])
+
+    for _ in range(200):
+        query = rng.integers(-1, len(vocab), size=rng.integers(1, 6)).tolist()
+        n = int(rng.integers(1, 12))
+        scores = reference.get_scores([str(t) for t in query])
+        # get_top_n breaks exact ties arbitrarily (unstable argsort); top_n gives them to the higher index
+        expected = np.argsort(scores, kind="stable")[::-1][:n].tolist()
+        assert index.top_n(query, n=n) == expected, query
+        okapi = reference.get_top_n([str(t) for t in query], list(range(len(docs))), n=n)
+        assert np.allclose(scores[expected], scores[okapi])
+
+    # Ids without postings (a gap in the vocabulary) and postings that end before
+    # the candidates do must not index past the arrays
+    gapped = BM25Index(np.array([0, 0, 5, 0, 5, 0], dtype=np.int32), np.array([0, 2, 3, 6], dtype=np.int64))
+    for query in ([0, 3, 5], [3, 0], [5, 3]):
+        for n in (1, 2, 3):
+            expected = np.argsort(gapped.get_scores(query), kind="stable")[::-1][:n].tolist()
+            assert gapped.top_n(query, n=n) == expected, (query, n)
+    print("✅ test_bm25_index_top_n_matches_bm25okapi passed!")
+
+def test_reranker_cache_and_adaptive_depth():
+    reranker = Reranker()
+    reranker.model = MagicMock()
+    reranker.model.predict.side_effect = lambda pairs: [len(doc) for _, doc in pairs]
+    docs = [Document(page_content="x" * i, metadata={"chunk_id": f"chunk_{i}"}) for i in range(1, 8)]
+
+    # No fused agreement: every candidate is scored, then served from the cache
+    tied = [(doc, 1 / 61) for doc in docs]
+    assert [d.page_content for d in reranker.rerank("q", tied)] == ["x" * 7, "x" * 6, "x" * 5]
+    reranker.rerank("q", tied)
+    assert reranker.model.predict.call_count == 1 and reranker.stats["hits"] == 7
+
+    # The top three candidates were found by both retrievers: nothing to rerank
+    agreed = [(docs[0], 2 / 61), (docs[1], 2 / 62), (docs[2], 2 / 63)] + [(d, 1 / 62) for d in docs[3:]]
+    assert reranker.rerank("other", agreed) == docs[:3]
+    assert reranker.model.predict.call_count == 1
+    print("✅ test_reranker_cache_and_adaptive_depth passed!")
+
+def test_models_are_shared_across_instances():
+    first, second = CodeRAG("https://github.com/test/one"), CodeRAG("https://github.com/test/two")
+    assert first.embeddings is second.embeddings
+    assert first.reranker is second.reranker
+    print("✅ test_models_are_shared_across_instances passed!")
+
+def test_backend_defers_heavy_imports():
+    # Fresh interpreter, so the module mocks above don't count
+    loaded = {name.split(".")[0] for name in import_times("backend")}
+    assert not loaded & set(HEAVY_PACKAGES)
+    print("✅ test_backend_defers_heavy_imports passed!")
+
+def test_context_packer_merges_overlaps_and_fits_budget():
+    text = "".join(f"line {i}\n" for i in range(100))
+    def chunk(chunk_id, start, end, source="a.py"):
+        return Document(page_content=text[start:end], metadata={"source": source, "chunk_id": chunk_id, "start": start})
+
+    # Overlapping chunks of a.py become one span; the exact duplicate is dropped
+    first, second, other = chunk("c1", 0, 120), chunk("c2", 100, 200), chunk("c3", 300, 420, source="b.py")
+    packed = ContextPacker(budget_tokens=1000).pack([second, other, first, second])
+    assert [d.metadata["chunk_ids"] for d in packed] == [["c1", "c2"], ["c3"]]
+    assert packed[0].page_content == text[:200]
+
+    # Only what fits the budget is kept
+    packed = ContextPacker(budget_tokens=40).pack([chunk("c5", 0, 400, source="c.py"), chunk("c4", 500, 600)])
+    assert [d.metadata["chunk_ids"] for d in packed] == [["c4"]]
+    assert sum(d.metadata["tokens"] for d in packed) <= 40
+    print("✅ test_context_packer_merges_overlaps_and_fits_budget passed!")
+
+def test_file_selector_skips_and_reports():
+    root = tempfile.mkdtemp()
+    files = {
+        "src/main.py": "print('hi')\n",
+        "src/debug.py": "print('debug')\n",
+        "src/app.min.js": "var a=1;\n",
+        "src/blob.py": "a\0b",
+        "src/fixture.json": "[" + "0," * 100000 + "0]",
+        "node_modules/lib/index.js": "module.exports = 1;\n",
+        "third/lib.go": "package lib\n",
+        "vendor/ours/keep.go": "package ours\n",
+        ".gitignore": "debug.py\n",
+        ".gitattributes": "third/** linguist-vendored\nvendor/ours/** -linguist-vendored\n",
+    }
+    for rel_path, content in files.items():
+        os.makedirs(os.path.join(root, os.path.dirname(rel_path)), exist_ok=True)
+        with open(os.path.join(root, rel_path), "w") as f:
+            f.write(content)
+
+    selector = FileSelector(root)
+    walked = [os.path.relpath(p, root).replace(os.sep, "/") for p in selector.walk()]
+    assert walked == ["src/main.py", "vendor/ours/keep.go"]
+    assert {reason: entry["count"] for reason, entry in selector.report().items()} == {
+        "vendored": 2, "gitignored": 1, "generated": 1, "binary": 1, "too large": 1}
+    # Single-path checks (incremental updates) agree with the walk
+    assert [p for p in files if FileSelector(root).accepts(p)] == walked
+    print("✅ test_file_selector_skips_and_reports passed!")
+
+def test_deduplicator_aliases_exact_and_near_duplicates():
+    body = "".join(f"def handler_{i}(request):\n    return render(request, 'page_{i}.html')\n" for i in range(12))
+    chunks = [(0, None, body), (len(body), None, "print('done')\n")]
+    dedupe = Deduplicator()
+    assert [c[0] for c in dedupe.unique("a.py", chunks, 0)] == ["chunk_0", "chunk_1"]
+    # A copied file is caught whole; a lightly edited copy chunk by chunk
+    assert dedupe.unique("copy/a.py", chunks, 2) == []
+    edited = [(0, None, body.replace("page_3", "page_three")), (len(body), None, "print('finished')\n")]
+    assert [c[0] for c in dedupe.unique("b.py", edited, 2)] == ["chunk_2"]
+    assert dedupe.aliases == {"chunk_0": ["copy/a.py", "b.py"], "chunk_1": ["copy/a.py"]}
+    assert dedupe.stats["duplicate files"] == 1 and dedupe.stats["near-duplicate chunks"] == 1
+
+    # Changing the original orphans its copies, which then have to be indexed again
+    restored = Deduplicator(dedupe.state())
+    assert restored.forget(["a.py"]) == ["b.py", "copy/a.py"]
+    assert restored.aliases == {} and list(restored.chunks) == ["chunk_2"]
+    print("✅ test_deduplicator_aliases_exact_and_near_duplicates passed!")
+
+def test_structural_chunks_follow_code_boundaries():
+    method = "    def method_{0}(self, value):\n        # step {0}\n        return value * {0} + self.offset\n\n"
+    source = "import os\n\n\n@decorator\nclass Big:\n" + "".join(method.format(i) for i in range(8)) + "\ndef tail():\n    return os.sep\n"
+    chunks = _chunk_text(source, "py", budget=60)
+    assert all(tokens <= 60 and source[start:start + len(text)] == text for start, tokens, text in chunks)
+    # No overlap, nothing dropped, and every chunk starts on a statement
+    assert " ".join(text for _, _, text in chunks).split() == source.split()
+    assert [text.split("(")[0].split()[-1] for _, _, text in chunks][1:] == ["method_2", "method_4", "method_6"]
+    # The decorator stays with its class, and the last methods share a chunk with what follows the class
+    assert chunks[0][2].startswith("import os\n\n\n@decorator\nclass Big:")
+    assert chunks[-1][2].endswith("def tail():\n    return os.sep")
+
+    js = "function a() {\n  return 1;\n}\n\n" + "// b\nfunction b() {\n  if (x) {\n    return '}';\n  }\n}\n"
+    assert [text for _, _, text in _chunk_text(js * 3, "js", budget=30)][:2] == [
+        "function a() {\n  return 1;\n}", "// b\nfunction b() {\n  if (x) {\n    return '}';\n  }\n}"]
+    print("✅ test_structural_chunks_follow_code_boundaries passed!")
+
+def test_chunking_long_comment_and_define_runs_is_linear():
+    js = "".join(f"// comment line {i} with a few words\n" for i in range(800)) + "function f() {\n  return 1;\n}\n"
+    c = "".join(f"#define MACRO_{i}(x) ((x) + {i})\n" for i in range(1200))
+    started = time.time()
+    for text, ext in ((js, "js"), (c, "c")):
+        chunks = _chunk_text(text, ext)
+        assert all(text[start:start + len(chunk)] == chunk for start, _, chunk in chunks)
+        assert " ".join(chunk for _, _, chunk in chunks).split() == text.split()
+    # Preprocessor lines are statements in C, so every chunk starts on one
+    assert all(chunk.startswith("#define") for _, _, chunk in _chunk_text(c, "c"))
+    assert time.time() - started < 2
+
+    # If the structural pass fails, the file is still chunked by lines
+    with patch("backend._line_levels", side_effect=RecursionError("too deep")):
+        chunks = _chunk_text(c, "c")
+    assert " ".join(chunk for _, _, chunk in chunks).split() == c.split()
+    print("✅ test_chunking_long_comment_and_define_runs_is_linear passed!")
+
+def test_large_files_are_split_in_windows():
+    text = "".join(f"def row_{i}(db):\n    return db.insert({{'id': {i}, 'name': 'row {i}'}})\n\n" for i in range(400))
+    path = os.path.join(tempfile.mkdtemp(), "dump.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+    windows = list(_split_file_windows(path, window_chars=2000))
+    assert len(windows) > 10
+    chunks = [chunk for window in windows for chunk in window]
+    # Offsets are for the whole file, and windows end between functions, so nothing is cut or repeated
+    assert all(text[start:start + len(chunk)] == chunk for start, _, chunk in chunks)
+    assert " ".join(chunk for _, _, chunk in chunks).split() == text.split()
+    assert all(chunk.startswith("def row_") for _, _, chunk in chunks)
+
+    # Like small files, undecodable and unreadable ones are skipped, not indexed with U+FFFD
+    with open(path, "ab") as f:
+        f.write("# caf\u00e9\n".encode("latin-1"))
+    assert list(_split_file_windows(path, window_chars=2000)) == []
+    assert list(_split_file_windows(path + ".missing", window_chars=2000)) == []
+    print("✅ test_large_files_are_split_in_windows passed!")
+
+def test_embedding_cache_evicts_compacts_and_reopens():
+    path = tempfile.mkdtemp()
+    cache = EmbeddingCache(path, "model", max_entries=8)
+    keys = [cache.key(f"text {i}") for i in range(10)]
+    vectors = np.arange(40, dtype=np.float32).reshape(10, 4)
+    cache.put_many(keys[:6], vectors[:6])
+    assert set(cache.get_many(keys[:8])) == set(range(6))
+    assert np.array_equal(cache.get_many([keys[3]])[0], vectors[3])
+
+    # Keys 3 and 0 were read last, so they survive; going past max_entries drops the LRU quarter into a new file
+    cache.get_many([keys[0]])
+    cache.put_many(keys[6:], vectors[6:])
+    assert len(cache) == 6 and cache.generation == 1
+    found = cache.get_many(keys)
+    assert set(found) == {0, 3, 6, 7, 8, 9}
+    assert all(np.array_equal(found[i], vectors[i]) for i in found)
+    assert sorted(os.listdir(cache.path)).count("embeddings.1.f32") == 1
+    assert "embeddings.0.f32" not in os.listdir(cache.path)
+
+    # Rows are journaled as they are added, so they survive without a flush; flush folds them in
+    reopened = EmbeddingCache(path, "model", max_entries=8)
+    assert set(reopened.get_many(keys)) == {0, 3, 6, 7, 8, 9}
+    reopened.flush()
+    assert os.path.getsize(os.path.join(reopened.path, "journal.msgpack")) == 0
+    found = EmbeddingCache(path, "model", max_entries=8).get_many(keys)
+    assert all(np.array_equal(found[i], vectors[i]) for i in found) and len(found) == 6
+    print("✅ test_embedding_cache_evicts_compacts_and_reopens passed!")
+
+def test_embedding_cache_is_safe_across_processes():
+    path = tempfile.mkdtemp()
+    writer = (
+        "import os, sys, time, numpy as np\n"
+        "from backend import EmbeddingCache\n"
+        "cache = EmbeddingCache(sys.argv[1], 'model')\n"
+        "name = sys.argv[2]\n"
+        "# Both writers open the cache before either writes\n"
+        "open(os.path.join(sys.argv[1], name + '.ready'), 'w').close()\n"
+        "while len([f for f in os.listdir(sys.argv[1]) if f.endswith('.ready')]) < 2:\n"
+        "    time.sleep(0.01)\n"
+        "for batch in range(40):\n"
+        "    texts = [f'{name} {batch} {i}' for i in range(25)]\n"
+        "    vectors = [[hash(t) % 1000, batch, i, len(name)] for i, t in enumerate(texts)]\n"
+        "    cache.put_many([cache.key(t) for t in texts], np.array(vectors, dtype=np.float32))\n"
+        "cache.flush()\n"
+    )
+    env = {**os.environ, "PYTHONHASHSEED": "0"}
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    procs = [subprocess.Popen([sys.executable, "-c", writer, path, name], cwd=cwd, env=env) for name in ("a", "bb")]
+    assert all(proc.wait(timeout=120) == 0 for proc in procs)
+
+    # Each writer claimed its own rows, so every vector is intact after both flushed
+    cache = EmbeddingCache(path, "model")
+    texts = [f"{name} {batch} {i}" for name in ("a", "bb") for batch in range(40) for i in range(25)]
+    found = cache.get_many([cache.key(t) for t in texts])
+    assert len(found) == len(texts) == len(cache)
+    for n, text in enumerate(texts):
+        name, batch, i = text.split()
+        assert found[n][1:].tolist() == [int(batch), int(i), len(name)], text
+    print("✅ test_embedding_cache_is_safe_across_processes passed!")
+
 if __name__ == "__main__":
     test_clean_code()
     test_caching()
+    test_retrieval_overlaps_vector_and_keyword_search()
+    test_chat_session_carries_ollama_context()
+    test_answer_cache_skips_follow_ups()
+    test_bm25_index_matches_full_scoring()
+    test_bm25_index_top_n_matches_bm25okapi()
+    test_reranker_cache_and_adaptive_depth()
+    test_models_are_shared_across_instances()
+    test_context_packer_merges_overlaps_and_fits_budget()
+    test_file_selector_skips_and_reports()
+    test_deduplicator_aliases_exact_and_near_duplicates()
+    test_structural_chunks_follow_code_boundaries()
+    test_chunking_long_comment_and_define_runs_is_linear()
+    test_large_files_are_split_in_windows()
+    test_embedding_cache_evicts_compacts_and_reopens()
+    test_embedding_cache_is_safe_across_processes()
+    test_backend_defers_heavy_imports()